@@ -0,0 +1,53 @@
+import hashlib
+
+from flask import json
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class SearchCache(object):
+    """
+    Cache search responses in Redis. Rather than tracking which cached
+    responses are affected by a given write, every cache key incorporates a
+    version number which is incremented whenever data is modified, so stale
+    responses are simply never read again and expire on their own.
+    """
+    def __init__(self, client, timeout=60, prefix='scout'):
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+        self.version_key = '%s:version' % prefix
+
+    @classmethod
+    def from_config(cls, config):
+        url = config.get('SEARCH_CACHE_URL')
+        if not url:
+            return None
+        elif redis is None:
+            raise RuntimeError('SEARCH_CACHE_URL is set, but the redis '
+                               'package is not installed.')
+        return cls(
+            redis.Redis.from_url(url),
+            timeout=config.get('SEARCH_CACHE_TIMEOUT') or 60)
+
+    def make_key(self, *parts):
+        version = self.client.get(self.version_key) or b'0'
+        if not isinstance(version, bytes):
+            version = str(version).encode('utf-8')
+        key_data = json.dumps(parts).encode('utf-8')
+        return '%s:search:%s' % (
+            self.prefix,
+            hashlib.sha1(version + b':' + key_data).hexdigest())
+
+    def get(self, key):
+        data = self.client.get(key)
+        if data is not None:
+            return json.loads(data)
+
+    def set(self, key, value):
+        self.client.setex(key, self.timeout, json.dumps(value))
+
+    def invalidate(self):
+        self.client.incr(self.version_key)
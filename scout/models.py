@@ -1,8 +1,12 @@
 import base64
 import datetime
 import hashlib
+from io import BytesIO
 import mimetypes
+import os
 import sys
+import tempfile
+import zlib
 
 from peewee import *
 from playhouse.fields import CompressedField
@@ -25,6 +29,9 @@ else:
 
 database = SqliteExtDatabase(None, regexp_function=True)
 
+# Size of the chunks read from file-like objects when storing attachments.
+CHUNK_SIZE = 64 * 1024
+
 
 class Document(FTSModel):
     """
@@ -73,37 +80,79 @@ class Document(FTSModel):
         return (Index
                 .select()
                 .join(IndexDocument)
-                .where(IndexDocument.document == self.docid))
+                .where(IndexDocument.document == self.docid)
+                .order_by(Index.name))
+
+    def delete_instance(self, *args, **kwargs):
+        # Because Document is an FTS virtual table, SQLite cannot enforce
+        # foreign-keys (and hence ON DELETE CASCADE) against it, so the
+        # related rows are removed explicitly in the same transaction.
+        with database.atomic():
+            (IndexDocument
+             .delete()
+             .where(IndexDocument.document == self.docid)
+             .execute())
+            (Attachment
+             .delete()
+             .where(Attachment.document == self.docid)
+             .execute())
+            self.delete_metadata()
+            return super(Document, self).delete_instance(*args, **kwargs)
 
     def attach(self, filename, data):
-        filename = secure_filename(filename)
-        if isinstance(data, unicode_type):
-            data = data.encode('utf-8')
-        hash_obj = hashlib.sha256(data)
-        data_hash = base64.b64encode(hash_obj.digest())
-        try:
-            with database.atomic():
-                data_obj = BlobData.create(hash=data_hash, data=data)
-        except IntegrityError:
-            pass
-
-        mimetype = mimetypes.guess_type(filename)[0] or 'text/plain'
-        try:
-            with database.atomic():
-                attachment = Attachment.create(
-                    document=self,
-                    filename=filename,
-                    hash=data_hash,
-                    mimetype=mimetype)
-        except IntegrityError:
-            attachment = (Attachment
-                          .get((Attachment.document == self) &
-                               (Attachment.filename == filename)))
-            attachment.hash = data_hash
-            attachment.mimetype = mimetype
-            attachment.save(only=[Attachment.hash, Attachment.mimetype])
-
-        return attachment
+        return self.attach_many([(filename, data)])[0]
+
+    def attach_many(self, files):
+        """
+        Store any number of attachments, given as an iterable of
+        (filename, data) 2-tuples. All the blobs are written with a single
+        query, as are all the attachments. Returns a list of the
+        :py:class:`Attachment` instances.
+        """
+        blobs = {}
+        attachments = {}
+        for filename, data in files:
+            filename = secure_filename(filename)
+            if isinstance(data, unicode_type):
+                data = data.encode('utf-8')
+            if isinstance(data, bytes):
+                data = BytesIO(data)
+
+            data_hash, compressed, length = BlobData.hash_and_compress(data)
+            blobs[data_hash] = compressed
+            attachments[filename] = {
+                'document': self.docid,
+                'filename': filename,
+                'hash': data_hash,
+                'data_length': length,
+                'mimetype': mimetypes.guess_type(filename)[0] or 'text/plain',
+                'timestamp': datetime.datetime.now()}
+
+        with database.atomic():
+            (BlobData
+             .insert_many([
+                 {'hash': data_hash, 'data': Value(compressed, unpack=False)}
+                 for data_hash, compressed in blobs.items()])
+             .on_conflict_ignore()
+             .execute())
+
+            # If the document already has an attachment with the given name,
+            # its data and mimetype are replaced.
+            (Attachment
+             .insert_many(list(attachments.values()))
+             .on_conflict(
+                 conflict_target=[Attachment.document, Attachment.filename],
+                 preserve=[Attachment.hash, Attachment.mimetype,
+                           Attachment.data_length])
+             .execute())
+
+        query = (Attachment
+                 .select_with_data()
+                 .where(
+                     (Attachment.document == self.docid) &
+                     (Attachment.filename << list(attachments))))
+        by_filename = {attachment.filename: attachment for attachment in query}
+        return [by_filename[filename] for filename in attachments]
 
     def detach(self, filename):
         return (Attachment
@@ -128,11 +177,27 @@ class Attachment(BaseModel):
     mimetype = TextField()
     timestamp = DateTimeField(default=datetime.datetime.now, index=True)
 
+    # The uncompressed length of the data, which is not known for
+    # attachments stored by older versions of Scout.
+    data_length = IntegerField(null=True)
+
     class Meta:
         indexes = (
             (('document', 'filename'), True),
         )
 
+    @classmethod
+    def select_with_data(cls):
+        """
+        Select attachments along with the compressed contents of their blob,
+        which can then be decompressed in chunks without the data being
+        read again.
+        """
+        return (cls
+                .select(cls, BlobData.data.cast('BLOB').alias('compressed'))
+                .join(BlobData, on=(cls.hash == BlobData.hash))
+                .objects())
+
     @property
     def blob(self):
         if not hasattr(self, '_blob'):
@@ -141,6 +206,10 @@ class Attachment(BaseModel):
 
     @property
     def length(self):
+        if self.data_length is not None:
+            return self.data_length
+        elif hasattr(self, 'compressed'):
+            return BlobData.decompressed_length(self.compressed)
         return len(self.blob.data)
 
 
@@ -149,6 +218,87 @@ class BlobData(BaseModel):
     hash = TextField(primary_key=True)
     data = CompressedField(compression_level=6, algorithm='zlib')
 
+    @classmethod
+    def hash_and_compress(cls, file_obj):
+        """
+        Read the file-like object in chunks, returning a 3-tuple of the
+        base64-encoded SHA256 hash of its contents, the zlib-compressed data
+        and the uncompressed length, so the uncompressed data is never held
+        in memory all at once.
+        """
+        hash_obj = hashlib.sha256()
+        compressor = zlib.compressobj(cls.data.compression_level)
+        accum = []
+        length = 0
+        while True:
+            chunk = file_obj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if isinstance(chunk, unicode_type):
+                chunk = chunk.encode('utf-8')
+            hash_obj.update(chunk)
+            length += len(chunk)
+            accum.append(compressor.compress(chunk))
+        accum.append(compressor.flush())
+        data_hash = base64.b64encode(hash_obj.digest()).decode('ascii')
+        return data_hash, b''.join(accum), length
+
+    @classmethod
+    def iter_decompress(cls, data):
+        """
+        Decompress the raw (compressed) value of the data column, yielding
+        chunks of at most `CHUNK_SIZE` bytes.
+        """
+        decompressor = zlib.decompressobj()
+        data = memoryview(data)
+        for i in range(0, len(data), CHUNK_SIZE):
+            buf = data[i:i + CHUNK_SIZE]
+            while buf:
+                chunk = decompressor.decompress(buf, CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                buf = decompressor.unconsumed_tail
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def decompressed_length(cls, data):
+        return sum(len(chunk) for chunk in cls.iter_decompress(data))
+
+    @staticmethod
+    def get_filename(data_hash):
+        # The base64-encoded hash may contain "/" and "+", so use the URL-safe
+        # alphabet when converting it into a filename.
+        return data_hash.replace('+', '-').replace('/', '_').rstrip('=')
+
+    @classmethod
+    def export(cls, data_hash, directory, compressed=None, mode=0o644):
+        """
+        Write the uncompressed data to a file in the given directory, if it
+        does not exist already, and return the filename. If the compressed
+        data is already in memory it can be passed in, otherwise it is read
+        from the database.
+
+        The file is readable by other users (`mode`), as it is typically
+        served by a front-end server running as a different user.
+        """
+        filename = os.path.join(directory, cls.get_filename(data_hash))
+        if not os.path.exists(filename):
+            if compressed is None:
+                compressed = (cls
+                              .select(cls.data.cast('BLOB'))
+                              .where(cls.hash == data_hash)
+                              .scalar())
+            fd, tmp_filename = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in cls.iter_decompress(compressed):
+                    fh.write(chunk)
+            # mkstemp() creates the file with mode 0600.
+            os.chmod(tmp_filename, mode)
+            os.rename(tmp_filename, filename)
+        return filename
+
 
 class Metadata(BaseModel):
     """
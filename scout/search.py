@@ -20,6 +20,12 @@ from .models import Metadata
 
 
 class DocumentSearch(object):
+    SORT_OPTIONS = {
+        'content': Document.content,
+        'id': Document.docid,
+        'identifier': Document.identifier,
+    }
+
     def search(self, phrase, index=None, ranking='bm25', ordering=None,
                **filters):
         phrase = phrase.strip()
@@ -94,14 +100,11 @@ class DocumentSearch(object):
 
     def apply_rank_and_sort(self, query, ranking, ordering, sort_options=None,
                             sort_default='id'):
-        sort_options = sort_options or {
-            'content': Document.content,
-            'id': Document.docid,
-            'identifier': Document.identifier,
-        }
+        sort_options = sort_options or self.SORT_OPTIONS
         if ranking is not None:
             rank = self.get_rank_expression(ranking)
-            sort_options['score'] = rank
+            # Copy the options rather than modifying the shared dict.
+            sort_options = dict(sort_options, score=rank)
             sort_default = 'score'
 
             # Add score to the selected columns.
@@ -1,10 +1,17 @@
 import operator
 
 from flask import url_for
-from peewee import prefetch
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from scout.models import Attachment
-from scout.models import Document
+from scout.models import BlobData
 from scout.models import Index
 from scout.models import IndexDocument
 from scout.models import Metadata
@@ -19,7 +26,7 @@ class Serializer(object):
 
 
 class DocumentSerializer(object):
-    def serialize(self, document, prefetched=False, include_score=False):
+    def serialize(self, document, include_score=False):
         data = {
             'id': document.docid,
             'identifier': document.identifier,
@@ -38,20 +45,14 @@ class DocumentSerializer(object):
                 pk=attachment.filename)}
             for attachment in sorted(document.attachments, key=_filename)]
 
-        if prefetched:
-            data['metadata'] = dict((metadata.key, metadata.value)
-                                    for metadata in document.metadata_set)
-            data['indexes'] = [idx_doc.index.name
-                               for idx_doc in document.indexdocument_set]
-        else:
-            data['metadata'] = document.metadata
-            indexes = (Index
-                       .select(Index.name)
-                       .join(IndexDocument)
-                       .where(IndexDocument.document == document.docid)
-                       .order_by(Index.name)
-                       .tuples())
-            data['indexes'] = [name for name, in indexes]
+        data['metadata'] = document.metadata
+        indexes = (Index
+                   .select(Index.name)
+                   .join(IndexDocument)
+                   .where(IndexDocument.document == document.docid)
+                   .order_by(Index.name)
+                   .tuples())
+        data['indexes'] = [name for name, in indexes]
 
         if include_score:
             data['score'] = document.score
@@ -59,15 +60,87 @@ class DocumentSerializer(object):
         return data
 
     def serialize_query(self, query, include_score=False):
-        documents = prefetch(
-            query,
-            Attachment,
-            Metadata,
-            IndexDocument,
-            Index)
-        return [self.serialize(document, prefetched=True,
-                               include_score=include_score)
-                for document in documents]
+        """
+        Serialize the documents returned by a query, or a list of rows which
+        have already been fetched as dicts. Rows are fetched as dicts rather
+        than model instances, and the related attachments, metadata and
+        indexes are each loaded with a single query, by docid, so the search
+        itself is not re-evaluated.
+        """
+        if hasattr(query, 'dicts'):
+            query = query.dicts()
+
+        documents = []
+        by_id = {}
+        for row in query:
+            data = {
+                'id': row['docid'],
+                'identifier': row['identifier'],
+                'content': row['content'],
+                'attachments': [],
+                'metadata': {},
+                'indexes': [],
+            }
+            if include_score:
+                data['score'] = row['score']
+            documents.append(data)
+            by_id[row['docid']] = data
+
+        if not by_id:
+            return documents
+
+        docids = list(by_id)
+        attachments = list(Attachment
+                           .select(Attachment.document, Attachment.filename,
+                                   Attachment.mimetype, Attachment.timestamp,
+                                   Attachment.hash, Attachment.data_length)
+                           .where(Attachment.document << docids)
+                           .order_by(Attachment.filename)
+                           .tuples())
+
+        # Attachments stored by older versions of Scout have no length, so
+        # it is determined from the blob data.
+        missing = set(row[4] for row in attachments if row[5] is None)
+        lengths = {}
+        if missing:
+            blobs = (BlobData
+                     .select(BlobData.hash, BlobData.data.cast('BLOB'))
+                     .where(BlobData.hash << list(missing))
+                     .tuples())
+            lengths = dict((data_hash, BlobData.decompressed_length(data))
+                           for data_hash, data in blobs)
+
+        for row in attachments:
+            docid, filename, mimetype, timestamp, data_hash, length = row
+            if length is None:
+                length = lengths.get(data_hash)
+            by_id[docid]['attachments'].append({
+                'filename': filename,
+                'mimetype': mimetype,
+                'timestamp': str(timestamp),
+                'data_length': length,
+                'data': url_for(
+                    'attachment_download',
+                    document_id=docid,
+                    pk=filename)})
+
+        metadata = (Metadata
+                    .select(Metadata.document, Metadata.key, Metadata.value)
+                    .where(Metadata.document << docids)
+                    .tuples())
+        for docid, key, value in metadata:
+            by_id[docid]['metadata'][key] = value
+
+        indexes = (Index
+                   .select(IndexDocument.document, Index.name)
+                   .join(IndexDocument)
+                   .where(IndexDocument.document << docids)
+                   .order_by(IndexDocument.id)
+                   .tuples())
+        for docid, name in indexes:
+            by_id[docid]['indexes'].append(name)
+
+        return documents
 
 
 class AttachmentSerializer(Serializer):
@@ -98,3 +171,36 @@ class IndexSerializer(Serializer):
             'name': index.name,
             'documents': url_for('index_view_detail', pk=index.name),
             'document_count': document_count}
+
+
+if orjson is not None and DefaultJSONProvider is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """
+        Flask JSON provider that uses `orjson` to encode and decode JSON.
+        Output matches Flask's default provider: keys are sorted, and dates
+        and other non-native types are handled by Flask's default hook.
+        """
+        option = (orjson.OPT_NON_STR_KEYS |
+                  orjson.OPT_PASSTHROUGH_DATETIME |
+                  orjson.OPT_SORT_KEYS)
+
+        def _dumps(self, obj):
+            option = self.option
+            if (self.compact is None and self._app.debug) or \
+               self.compact is False:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=option)
+
+        def dumps(self, obj, **kwargs):
+            return self._dumps(obj).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                self._dumps(obj) + b'\n',
+                mimetype=self.mimetype)
+else:
+    OrjsonProvider = None
@@ -4,6 +4,8 @@ import os
 import sys
 
 from flask import Flask
+from playhouse.migrate import migrate
+from playhouse.migrate import SqliteMigrator
 from werkzeug.serving import run_simple
 
 from scout.exceptions import InvalidRequestException
@@ -69,6 +71,15 @@ def initialize_database(database_file, pragmas=None):
             IndexDocument,
             Metadata])
 
+        # Databases created by older versions of Scout do not store the
+        # length of each attachment.
+        table = Attachment._meta.table_name
+        columns = [column.name for column in database.get_columns(table)]
+        if 'data_length' not in columns:
+            migrator = SqliteMigrator(database)
+            migrate(migrator.add_column(table, 'data_length',
+                                        Attachment.data_length))
+
 
 def run(app):
     if app.config['DEBUG']:
@@ -1,6 +1,14 @@
+import base64
+import datetime
+import decimal
 import json
 import optparse
+import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import unittest
 try:
     from urllib.parse import urlencode
@@ -8,9 +16,14 @@ except ImportError:
     from urllib import urlencode
 from io import BytesIO
 
+from flask import Flask
 from playhouse.sqlite_ext import *
 from playhouse.test_utils import assert_query_count
+from playhouse.test_utils import count_queries
+from werkzeug.serving import make_server
+from werkzeug.serving import WSGIRequestHandler
 
+from scout.cache import SearchCache
 from scout.constants import SEARCH_BM25
 from scout.exceptions import InvalidRequestException
 from scout.exceptions import InvalidSearchException
@@ -22,12 +35,23 @@ from scout.models import Index
 from scout.models import IndexDocument
 from scout.models import Metadata
 from scout.search import DocumentSearch
+from scout.serializers import OrjsonProvider
 from scout.server import create_server
+from scout.validator import RequestValidator
+from scout.views import register_views
+try:
+    import scout_client
+except ImportError:
+    scout_client = None
 
 
 test_config = {
     'DATABASE': ':memory:',
     'PAGINATE_BY': 10,
+    'SQLITE_PRAGMAS': [
+        ('journal_mode', 'memory'),
+        ('synchronous', 0),
+        ('temp_store', 'memory')],
 }
 app = create_server(test_config)
 engine = DocumentSearch()
@@ -40,6 +64,12 @@ def get_option_parser():
         '--quiet',
         action='store_true',
         dest='quiet')
+    parser.add_option(
+        '-p',
+        '--parallel',
+        action='store_true',
+        dest='parallel',
+        help='Run the tests in parallel (requires pytest-xdist).')
     return parser
 
 def json_load(data):
@@ -67,13 +97,14 @@ class BaseTestCase(unittest.TestCase):
         database.connect()
         database.foreign_keys = 0
         assert database.get_tables() == []
-        database.create_tables([
-            Attachment,
-            BlobData,
-            Document,
-            Metadata,
-            Index,
-            IndexDocument])
+        with database.atomic():
+            database.create_tables([
+                Attachment,
+                BlobData,
+                Document,
+                Metadata,
+                Index,
+                IndexDocument])
 
 
 class TestSearch(BaseTestCase):
@@ -240,7 +271,7 @@ class TestSearch(BaseTestCase):
 
     def test_search_queries(self):
         self.populate()
-        with assert_query_count(9):
+        with assert_query_count(6):
             results = self.search(
                 'default',
                 'testing',
@@ -349,6 +380,70 @@ class TestModelAPIs(BaseTestCase):
             {'document': document.get_id(), 'name': 'idx-2'},
         ])
 
+    def test_delete_document(self):
+        """
+        Test that deleting a document also removes its index memberships,
+        metadata and attachments.
+        """
+        alt_index = Index.create(name='alt')
+        doc = self.index.index('doc 1', foo='bar')
+        alt_index.add_to_index(doc)
+        doc.attach('foo.txt', 'foo')
+        other = self.index.index('doc 2', baz='nug')
+
+        doc.delete_instance()
+        self.assertEqual([d.get_id() for d in Document.select()],
+                         [other.get_id()])
+        self.assertEqual(IndexDocument.select().count(), 1)
+        self.assertEqual(Attachment.select().count(), 0)
+        self.assertEqual([m.key for m in Metadata.select()], ['baz'])
+
+    def test_attach_file_object(self):
+        """
+        Test that attachments can be read from file-like objects, and that
+        identical content is stored only once.
+        """
+        doc = self.index.index('doc 1')
+        data = b'huey and mickey ' * 10000
+        a1 = doc.attach('foo.txt', BytesIO(data))
+        a2 = doc.attach('bar.txt', data)
+        self.assertEqual(a1.hash, a2.hash)
+        self.assertEqual(BlobData.select().count(), 1)
+
+        a1_db = Attachment.get(Attachment.filename == 'foo.txt')
+        self.assertEqual(a1_db.blob.data, data)
+        self.assertEqual(a1_db.data_length, len(data))
+        self.assertEqual(a1_db.length, len(data))
+
+        compressed = (BlobData
+                      .select(BlobData.data.cast('BLOB'))
+                      .scalar())
+        chunks = list(BlobData.iter_decompress(compressed))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual(BlobData.decompressed_length(compressed), len(data))
+
+    def test_attach_many(self):
+        doc = self.index.index('doc 1')
+        a1 = doc.attach('foo.txt', 'foo')
+        with assert_query_count(4):
+            attachments = doc.attach_many([
+                ('bar.txt', 'bar'),
+                ('foo.txt', 'new foo'),
+                ('baz.jpg', 'bar')])
+
+        self.assertEqual(
+            [(a.filename, a.mimetype, a.blob.data) for a in attachments],
+            [('bar.txt', 'text/plain', b'bar'),
+             ('foo.txt', 'text/plain', b'new foo'),
+             ('baz.jpg', 'image/jpeg', b'bar')])
+
+        # The existing attachment was updated in-place.
+        self.assertEqual(attachments[1].id, a1.id)
+        self.assertEqual(attachments[1].timestamp, a1.timestamp)
+        self.assertEqual(Attachment.select().count(), 3)
+        self.assertEqual(BlobData.select().count(), 3)
+
     def test_search(self):
         """
         Basic tests for simple string searches of a single index. Use both
@@ -436,6 +531,27 @@ class TestSearchViews(BaseTestCase):
             {'document_count': 0, 'documents': '/i2/', 'id': 3, 'name': 'i2'},
         ])
 
+    def test_list_etag(self):
+        idx = Index.create(name='idx')
+        doc = idx.index('doc 1')
+        doc.attach('foo.txt', 'foo')
+
+        etags = {}
+        for url in ('/', '/documents/1/attachments/'):
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response.headers['ETag']
+
+            response = self.app.get(url, headers={'If-None-Match': etags[url]})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+
+        # Changes to the data are reflected in the ETag.
+        idx.index('doc 2')
+        response = self.app.get('/', headers={'If-None-Match': etags['/']})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etags['/'])
+
     def test_index_missing(self):
         response = self.app.get('/missing/')
         self.assertEqual(response.status_code, 404)
@@ -451,6 +567,7 @@ class TestSearchViews(BaseTestCase):
 
         response = self.app.get('/idx-a/')
         data = json_load(response.data)
+        self.assertEqual(data['document_count'], 12)
         self.assertEqual(data['page'], 1)
         self.assertEqual(data['pages'], 2)
         self.assertEqual(len(data['documents']), 10)
@@ -483,6 +600,103 @@ class TestSearchViews(BaseTestCase):
             'indexes': ['idx-b', 'idx-a'],
             'metadata': {}})
 
+    def test_cursor_pagination(self):
+        idx = Index.create(name='idx')
+        for i in range(25):
+            idx.index('document %s' % ('nug ' * (i % 7)), n=i)
+
+        def fetch(url, **params):
+            data = []
+            cursor = ''
+            while cursor is not None:
+                response = json_load(self.app.get('%s?%s' % (url, urlencode(
+                    dict(params, cursor=cursor)))).data)
+                self.assertFalse('page' in response)
+                data.append(response['documents'])
+                cursor = response['next_cursor']
+            return data
+
+        # Unranked results are ordered by id.
+        pages = fetch('/idx/')
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([doc['id'] for page in pages for doc in page],
+                         list(range(1, 26)))
+
+        # Ranked results are ordered by score, matching offset pagination.
+        pages = fetch('/documents/', q='nug')
+        self.assertEqual([len(page) for page in pages], [10, 10, 1])
+        documents = [doc for page in pages for doc in page]
+        scores = [doc['score'] for doc in documents]
+        self.assertEqual(scores, sorted(scores))
+        self.assertEqual(len(set(doc['id'] for doc in documents)), 21)
+
+        expected = []
+        for page in (1, 2, 3):
+            response = self.app.get('/documents/?q=nug&page=%s' % page)
+            expected.extend(d['score'] for d in json_load(response.data)[
+                'documents'])
+        self.assertEqual(scores, expected)
+
+        # The filtered count is only calculated when requested, and the
+        # search is only performed once.
+        with assert_query_count(5):
+            response = json_load(self.app.get('/documents/?cursor=').data)
+        self.assertFalse('filtered_count' in response)
+        with count_queries() as counter:
+            response = json_load(self.app.get('/idx/?q=nug&cursor=').data)
+        self.assertEqual(len(response['documents']), 10)
+        self.assertTrue(response['next_cursor'] is not None)
+        self.assertEqual(counter.count, 5)
+        searches = [query for query in counter.get_queries()
+                    if 'MATCH' in query.msg[0]]
+        self.assertEqual(len(searches), 1)
+        response = json_load(self.app.get(
+            '/documents/?cursor=&q=nug&with_count=1').data)
+        self.assertEqual(response['filtered_count'], 21)
+
+        # Metadata filters are applied.
+        pages = fetch('/idx/', n__in='0,1,2,3,4')
+        self.assertEqual([doc['metadata']['n'] for doc in pages[0]],
+                         ['0', '1', '2', '3', '4'])
+
+        # Index and attachment lists support cursors as well.
+        for i in range(11):
+            Index.create(name='idx-%02d' % i)
+        response = json_load(self.app.get('/?cursor=').data)
+        self.assertEqual([i['name'] for i in response['indexes']],
+                         ['idx'] + ['idx-%02d' % i for i in range(9)])
+        response = json_load(self.app.get(
+            '/?cursor=%s' % response['next_cursor']).data)
+        self.assertEqual([i['name'] for i in response['indexes']],
+                         ['idx-09', 'idx-10'])
+        self.assertTrue(response['next_cursor'] is None)
+
+        doc = Document.get(Document.docid == 1)
+        for i in range(12):
+            doc.attach('f%02d.txt' % i, 'x')
+        response = json_load(self.app.get(
+            '/documents/1/attachments/?cursor=').data)
+        self.assertEqual(len(response['attachments']), 10)
+        response = json_load(self.app.get(
+            '/documents/1/attachments/?cursor=%s' %
+            response['next_cursor']).data)
+        self.assertEqual([a['filename'] for a in response['attachments']],
+                         ['f10.txt', 'f11.txt'])
+
+        # Invalid cursors, or cursors combined with an ordering, are errors.
+        response = json_load(self.app.get('/?cursor=garbage').data)
+        self.assertEqual(response, {'error': 'Invalid cursor.'})
+        for values in ([{'a': 1}], [None], [['idx']]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(values).encode('utf-8')).decode('utf-8')
+            response = self.app.get('/?cursor=%s' % cursor)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json_load(response.data),
+                             {'error': 'Invalid cursor.'})
+        response = json_load(self.app.get('/?cursor=&ordering=id').data)
+        self.assertEqual(response, {
+            'error': 'The "ordering" parameter cannot be used with "cursor".'})
+
     def test_index_update_delete(self):
         idx = Index.create(name='idx')
         alt_idx = Index.create(name='alt-idx')
@@ -625,6 +839,120 @@ class TestSearchViews(BaseTestCase):
             'The following indexes were not found: missing, blah.')
         self.assertEqual(Document.select().count(), 0)
 
+    def test_index_document_existing_identifier(self):
+        Index.create(name='idx-a')
+        Index.create(name='idx-b')
+        response = self.post_json('/documents/', {
+            'content': 'doc 1',
+            'identifier': 'doc-1',
+            'index': 'idx-a',
+            'metadata': {'k1': 'v1'}})
+        self.assertEqual(response['id'], 1)
+
+        # Creating a document with an existing identifier updates it.
+        with assert_query_count(10):
+            response = self.post_json('/documents/', {
+                'content': 'doc 1 updated',
+                'identifier': 'doc-1',
+                'index': 'idx-b',
+                'metadata': {}})
+
+        self.assertEqual(response, {
+            'attachments': [],
+            'content': 'doc 1 updated',
+            'id': 1,
+            'identifier': 'doc-1',
+            'indexes': ['idx-b'],
+            'metadata': {}})
+        self.assertEqual(Document.select().count(), 1)
+
+    def test_batch_create(self):
+        Index.create(name='idx-a')
+        Index.create(name='idx-b')
+        existing = self.post_json('/documents/', {
+            'content': 'existing',
+            'identifier': 'doc-0',
+            'index': 'idx-a',
+            'metadata': {'k': 'v'}})
+
+        documents = [{'content': 'doc %s' % i,
+                      'identifier': 'doc-%s' % i,
+                      'indexes': ['idx-a', 'idx-b'] if i % 2 else ['idx-b'],
+                      'metadata': {'i': str(i)}}
+                     for i in range(100)]
+        with count_queries() as counter:
+            response = self.post_json('/batch/documents/', {
+                'documents': documents})
+
+        # All the documents are written in a single transaction.
+        begins = [query for query in counter.get_queries()
+                  if query.msg[0].startswith('BEGIN')]
+        self.assertEqual(len(begins), 1)
+
+        self.assertEqual(Document.select().count(), 100)
+        self.assertEqual(len(response['documents']), 100)
+
+        # The document with an existing identifier was updated.
+        doc0, doc1 = response['documents'][:2]
+        self.assertEqual(doc0['id'], existing['id'])
+        self.assertEqual(doc0, {
+            'attachments': [],
+            'content': 'doc 0',
+            'id': existing['id'],
+            'identifier': 'doc-0',
+            'indexes': ['idx-b'],
+            'metadata': {'i': '0'}})
+        self.assertEqual(doc1['content'], 'doc 1')
+        self.assertEqual(doc1['indexes'], ['idx-a', 'idx-b'])
+        self.assertEqual(doc1['metadata'], {'i': '1'})
+
+        # Validation errors are reported before anything is written.
+        response = self.post_json('/batch/documents/', {'documents': [
+            {'content': 'new doc', 'index': 'idx-a'},
+            {'content': 'new doc', 'index': 'missing'}]})
+        self.assertEqual(
+            response['error'],
+            'The following indexes were not found: missing.')
+
+        response = self.post_json('/batch/documents/', {'documents': [
+            {'content': 'new doc', 'index': 'idx-a'},
+            {'index': 'idx-a'}]})
+        self.assertEqual(response['error'], 'Missing required fields: content')
+
+        response = self.post_json('/batch/documents/', {'documents': 'x'})
+        self.assertEqual(response['error'], '"documents" must be a list.')
+        self.assertEqual(Document.select().count(), 100)
+
+        app.config['BATCH_MAX_DOCUMENTS'] = 2
+        self.addCleanup(app.config.pop, 'BATCH_MAX_DOCUMENTS')
+        response = self.post_json('/batch/documents/', {'documents': [
+            {'content': 'doc %s' % i, 'index': 'idx-a'} for i in range(3)]})
+        self.assertEqual(response['error'],
+                         'A batch may contain at most 2 documents.')
+        self.assertEqual(Document.select().count(), 100)
+
+        # Files cannot be uploaded with a batch.
+        response = self.app.post('/batch/documents/', data={
+            'data': json.dumps({'documents': [
+                {'content': 'updated', 'identifier': 'doc-0',
+                 'index': 'idx-a'}]}),
+            'file_0': (BytesIO(b'foo'), 'foo.txt')})
+        self.assertEqual(json_load(response.data), {
+            'error': 'Files cannot be attached to a batch of documents.'})
+        self.assertEqual(Attachment.select().count(), 0)
+
+    def test_document_identifier_batch(self):
+        # A document identified as "batch" can still be updated.
+        Index.create(name='idx')
+        document = self.post_json('/documents/', {
+            'content': 'original',
+            'identifier': 'batch',
+            'index': 'idx'})
+        response = self.post_json('/documents/batch/', {'content': 'updated'})
+        self.assertEqual(response['id'], document['id'])
+        self.assertEqual(response['content'], 'updated')
+        self.assertEqual(self.app.get('/documents/batch/').status_code, 200)
+
     def test_document_detail_get(self):
         idx = Index.create(name='idx')
         doc = idx.index('test doc', foo='bar')
@@ -641,10 +969,7 @@ class TestSearchViews(BaseTestCase):
             'metadata': {'foo': 'bar'}})
 
     def refresh_doc(self, doc):
-        return (Document
-                .all()
-                .where(Document._meta.primary_key == doc.get_id())
-                .get())
+        return Document.get_by_id(doc.get_id())
 
     def test_document_detail_post(self):
         idx = Index.create(name='idx')
@@ -679,14 +1004,28 @@ class TestSearchViews(BaseTestCase):
         response = self.post_json(url, {'metadata': None})
         assertDoc(doc, 'updated', {}, ['idx'])
 
-        # Test updating indexes.
+        # Test updating indexes. Existing memberships are left in-place.
+        idx_doc = IndexDocument.get(IndexDocument.document == doc.get_id())
         response = self.post_json(url, {'indexes': ['idx', 'alt-idx']})
         assertDoc(doc, 'updated', {}, ['alt-idx', 'idx'])
+        self.assertEqual(IndexDocument.get(
+            (IndexDocument.document == doc.get_id()) &
+            (IndexDocument.index == idx)).id, idx_doc.id)
 
         # Test clearing indexes.
         response = self.post_json(url, {'indexes': []})
         assertDoc(doc, 'updated', {}, [])
 
+        # An invalid update is rolled back entirely.
+        response = self.post_json(url, {
+            'content': 'invalid',
+            'metadata': {'k': 'v'},
+            'index': 'missing'})
+        self.assertEqual(
+            response['error'],
+            'The following indexes were not found: missing.')
+        assertDoc(doc, 'updated', {}, [])
+
         # Ensure alt_doc has not been affected.
         assertDoc(alt_doc, 'alt doc', {}, ['idx'])
 
@@ -817,8 +1156,53 @@ class TestSearchViews(BaseTestCase):
         resp_data = json_load(resp.data)
         self.assertEqual(resp_data['data_length'], 2)
 
-        resp = self.app.get('/documents/1/attachments/bar.png/download/')
+        with assert_query_count(1):
+            resp = self.app.get('/documents/1/attachments/bar.png/download/')
         self.assertEqual(resp.data, b'zz')
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertEqual(resp.headers['Content-Length'], '2')
+
+        resp = self.app.get('/documents/2/attachments/bar.png/download/')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_attachment_download_x_accel_redirect(self):
+        idx = Index.create(name='idx')
+        doc = idx.index('doc 1')
+        doc.attach('old.txt', 'not exported')
+
+        blob_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, blob_directory)
+        app.config['BLOB_DIRECTORY'] = blob_directory
+        app.config['X_ACCEL_REDIRECT_PREFIX'] = '/internal/blobs/'
+        self.addCleanup(app.config.pop, 'BLOB_DIRECTORY')
+        self.addCleanup(app.config.pop, 'X_ACCEL_REDIRECT_PREFIX')
+
+        with count_queries() as counter:
+            self.app.post('/documents/1/attachments/', data={
+                'data': '',
+                'file_0': (BytesIO(b'huey'), 'new.txt')})
+        attachment = Attachment.get(Attachment.filename == 'new.txt')
+        filename = BlobData.get_filename(attachment.hash)
+        path = os.path.join(blob_directory, filename)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), b'huey')
+
+        # The exported file is readable by the front-end server, and the blob
+        # that was just stored is not read back from the database.
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        self.assertFalse([query for query in counter.get_queries()
+                          if 'FROM "blobdata"' in query.msg[0]])
+
+        resp = self.app.get('/documents/1/attachments/new.txt/download/')
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['X-Accel-Redirect'],
+                         '/internal/blobs/%s' % filename)
+        self.assertEqual(resp.headers['Content-Type'], 'text/plain')
+
+        # Attachments which were not exported are served directly.
+        resp = self.app.get('/documents/1/attachments/old.txt/download/')
+        self.assertEqual(resp.data, b'not exported')
+        self.assertFalse('X-Accel-Redirect' in resp.headers)
 
     def search(self, index, query, page=1, **filters):
         filters.setdefault('ranking', SEARCH_BM25)
@@ -826,15 +1210,36 @@ class TestSearchViews(BaseTestCase):
         response = self.app.get('/%s/?%s' % (index, params))
         return json_load(response.data)
 
+    def index_documents(self, index, rows):
+        """
+        Store a list of (content, metadata) 2-tuples in the given index,
+        using a single query for each table.
+        """
+        start = (Document.select(fn.MAX(Document.docid)).scalar() or 0) + 1
+        docids = range(start, start + len(rows))
+        with database.atomic():
+            Document.insert_many([
+                {'docid': docid, 'content': content}
+                for docid, (content, _) in zip(docids, rows)]).execute()
+            IndexDocument.insert_many([
+                {'index': index, 'document': docid}
+                for docid in docids]).execute()
+            metadata = [
+                {'document': docid, 'key': key, 'value': value}
+                for docid, (_, data) in zip(docids, rows)
+                for key, value in sorted(data.items())]
+            if metadata:
+                Metadata.insert_many(metadata).execute()
+
     def test_search(self):
         idx = Index.create(name='idx')
         phrases = ['foo', 'bar', 'baz', 'nug nugs', 'blah nuggie foo', 'huey',
                    'zaizee']
-        for phrase in phrases:
-            idx.index('document %s' % phrase, special=True)
-
-        for i in range(10):
-            idx.index('document %s' % i, special=False)
+        self.index_documents(idx, [
+            ('document %s' % phrase, {'special': True})
+            for phrase in phrases])
+        self.index_documents(idx, [
+            ('document %s' % i, {'special': False}) for i in range(10)])
 
         response = self.search('idx', 'docum*')
         self.assertEqual(response['page'], 1)
@@ -882,15 +1287,14 @@ class TestSearchViews(BaseTestCase):
 
     def test_search_filters(self):
         idx = Index.create(name='idx')
-        data = (
+        data = [
             ('huey document', {'name': 'huey', 'kitty': 'yes'}),
             ('zaizee document', {'name': 'zaizee', 'kitty': 'yes'}),
             ('little huey bear', {'name': 'huey', 'kitty': 'yes'}),
             ('uncle huey', {'kitty': 'no'}),
             ('michael nuggie document', {'name': 'mickey', 'kitty': 'no'}),
-        )
-        for content, metadata in data:
-            idx.index(content, **metadata)
+        ]
+        self.index_documents(idx, data)
 
         def assertResults(query, metadata, expected):
             results = self.search('idx', query, **metadata)
@@ -914,6 +1318,14 @@ class TestSearchViews(BaseTestCase):
             {'kitty': 'yes'},
             ['huey document', 'zaizee document'])
 
+    def test_search_invalid_ranking(self):
+        Index.create(name='idx')
+        for _ in range(2):
+            response = self.search('idx', 'huey', ranking='nuggie')
+            self.assertEqual(response, {
+                'error': ('Unrecognized "ranking" value. Valid options are '
+                          'bm25, none, simple')})
+
     def test_query_count(self):
         idx_a = Index.create(name='idx-a')
         idx_b = Index.create(name='idx-b')
@@ -924,29 +1336,36 @@ class TestSearchViews(BaseTestCase):
             idx_b.index(phrase, doc, foo='bar', baze='nug')
 
         for idx in ['idx-a', 'idx-b']:
-            for query in ['nug', 'nug*', 'document', 'missing']:
-                with assert_query_count(9):
-                    # 1. Get index.
-                    # 2. Get # of docs in index.
-                    # 3. Prefetch indexes.
-                    # 4. Prefetch index documents.
-                    # 5. Prefetch metadata
-                    # 6. Fetch documents (top of prefetch).
-                    # 7. COUNT(*) for pagination.
-                    # 8. COUNT(*) for pagination.
+            for query in ['nug', 'nug*', 'document']:
+                with assert_query_count(6):
+                    # 1. Get index and # of docs in index.
+                    # 2. COUNT(*) for filtered count and pagination.
+                    # 3. Fetch documents.
+                    # 4. Fetch attachments.
+                    # 5. Fetch metadata.
+                    # 6. Fetch indexes.
                     self.search(idx, query)
 
-                with assert_query_count(9):
+                with assert_query_count(6):
                     self.search(idx, query, foo='bar')
 
-        with assert_query_count(9):
-            # Same as above.
+            with assert_query_count(3):
+                # No related data is fetched when there are no results.
+                self.search(idx, 'missing')
+
+        with assert_query_count(5):
+            # Same as above, but without a search term or filters the
+            # filtered count is the number of documents in the index.
             data = self.app.get('/idx-a/').data
 
-        with assert_query_count(8):
-            # Same as above minus first query for index.
+        with assert_query_count(5):
+            # Same as above, but the total # of docs is a separate query.
             self.app.get('/documents/')
 
+        with assert_query_count(6):
+            # Filtering by index requires the filtered count.
+            self.app.get('/documents/?index=idx-a')
+
         for i in range(10):
             Index.create(name='idx-%s' % i)
 
@@ -954,6 +1373,132 @@ class TestSearchViews(BaseTestCase):
             # 2 queries, one for list, one for pagination.
             self.app.get('/')
 
+    def test_query_count_attachments(self):
+        idx = Index.create(name='idx')
+        for i in range(3):
+            doc = idx.index('document %s' % i)
+            doc.attach('a%s.txt' % i, 'xx')
+            doc.attach('b%s.txt' % i, 'yyy')
+
+        def blob_queries(counter):
+            return [query for query in counter.get_queries()
+                    if '"blobdata"' in query.msg[0]]
+
+        # The stored lengths are used, so the blob data is not read and the
+        # number of queries does not depend on the number of files.
+        with count_queries() as counter:
+            response = self.app.get('/idx/')
+        self.assertEqual(counter.count, 5)
+        self.assertEqual(blob_queries(counter), [])
+
+        documents = json_load(response.data)['documents']
+        self.assertEqual(
+            [[a['data_length'] for a in d['attachments']] for d in documents],
+            [[2, 3], [2, 3], [2, 3]])
+
+        with count_queries() as counter:
+            response = self.app.get('/documents/1/attachments/')
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(blob_queries(counter), [])
+        attachments = json_load(response.data)['attachments']
+        self.assertEqual([a['data_length'] for a in attachments], [2, 3])
+
+        # Attachments stored without a length have it computed from the blob
+        # data, which is fetched with a single additional query.
+        Attachment.update(data_length=None).execute()
+        with assert_query_count(6):
+            response = self.app.get('/idx/')
+        documents = json_load(response.data)['documents']
+        self.assertEqual(
+            [[a['data_length'] for a in d['attachments']] for d in documents],
+            [[2, 3], [2, 3], [2, 3]])
+
+        response = self.app.get('/documents/1/attachments/')
+        attachments = json_load(response.data)['attachments']
+        self.assertEqual([a['data_length'] for a in attachments], [2, 3])
+
+        with assert_query_count(5):
+            response = self.app.post('/documents/1/attachments/', data={
+                'data': '{}',
+                'file_0': (BytesIO(b'cccc'), 'c.txt'),
+                'file_1': (BytesIO(b'ddddd'), 'd.txt')})
+        attachments = json_load(response.data)['attachments']
+        self.assertEqual(
+            sorted((a['filename'], a['data_length']) for a in attachments),
+            [('c.txt', 4), ('d.txt', 5)])
+
+    @unittest.skipIf(OrjsonProvider is None, 'orjson not installed')
+    def test_orjson_provider(self):
+        self.assertTrue(isinstance(app.json, OrjsonProvider))
+        with app.test_request_context():
+            response = app.json.response({
+                'b': datetime.date(2016, 1, 2),
+                'a': decimal.Decimal('1.5'),
+                1: 'one'})
+        self.assertEqual(
+            response.data,
+            b'{"1":"one","a":"1.5","b":"Sat, 02 Jan 2016 00:00:00 GMT"}\n')
+        self.assertEqual(app.json.loads(b'{"k": [1, 2]}'), {'k': [1, 2]})
+
+    def test_parse_post_cached(self):
+        validator = RequestValidator()
+        with app.test_request_context(
+                '/documents/', method='POST',
+                data=json.dumps({'content': 'foo', 'index': ''}),
+                content_type='application/json'):
+            data = validator.load_post_data()
+            self.assertTrue(validator.load_post_data() is data)
+            self.assertEqual(
+                validator.parse_post(optional=frozenset(('content',
+                                                         'index'))),
+                {'content': 'foo'})
+            self.assertEqual(
+                validator.parse_post(optional=frozenset(('content',
+                                                         'index')),
+                                     nullable=frozenset(('index',))),
+                {'content': 'foo', 'index': ''})
+
+    def test_post_data_not_shared(self):
+        # Requests made within a single application context share `g`, but
+        # each request's data is parsed separately.
+        with app.app_context():
+            for name in ('a', 'b'):
+                response = self.post_json('/', {'name': name})
+                self.assertEqual(response['name'], name)
+        self.assertEqual([index.name for index in Index.select()],
+                         ['a', 'b'])
+
+    def test_document_cache_not_shared(self):
+        idx = Index.create(name='idx')
+        idx.index('doc 1', identifier='doc-1')
+        with app.app_context():
+            response = self.app.get('/documents/1/')
+            self.assertEqual(response.status_code, 200)
+            response = self.app.delete('/documents/1/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.app.get('/documents/1/').status_code, 404)
+            self.assertEqual(
+                self.app.get('/documents/doc-1/').status_code, 404)
+
+    def test_extract_search_params(self):
+        validator = RequestValidator()
+        url = ('/idx/?q=foo&ranking=simple&ordering=id&ordering=-score&'
+               'k1=v1&k1=v2&k2=&page=2')
+        for _ in range(2):
+            with app.test_request_context(url):
+                ranking, ordering, filters = validator.extract_search_params()
+            self.assertEqual(ranking, 'simple')
+            self.assertEqual(ordering, ['id', '-score'])
+            self.assertEqual(filters, {'k1': ['v1', 'v2'], 'k2': ['']})
+
+            # The values returned are copies, which can safely be modified.
+            ordering.append('name')
+            filters['k1'].append('v3')
+
+        with app.test_request_context('/idx/?q=foo'):
+            self.assertEqual(validator.extract_search_params(),
+                             (SEARCH_BM25, [], {}))
+
     def test_authentication(self):
         Index.create(name='idx')
 
@@ -981,9 +1526,306 @@ class TestSearchViews(BaseTestCase):
         }])
 
 
+class MemoryClient(object):
+    """Implements the subset of the Redis client API used by SearchCache."""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, timeout, value):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1).encode()
+
+
+class TestSearchCache(BaseTestCase):
+    def setUp(self):
+        super(TestSearchCache, self).setUp()
+        self.cache = SearchCache(MemoryClient())
+        cache_app = Flask(__name__)
+        cache_app.config.update(test_config)
+        cache_app.extensions['scout_search_cache'] = self.cache
+        register_views(cache_app)
+        self.app = cache_app.test_client()
+
+    def test_search_cache(self):
+        idx = Index.create(name='idx')
+        idx.index('huey document')
+        idx.index('mickey document')
+
+        with assert_query_count(6):
+            data = json_load(self.app.get('/idx/?q=document').data)
+        self.assertEqual(len(data['documents']), 2)
+
+        # The response for an identical search is read from the cache,
+        # without querying the database.
+        with assert_query_count(0):
+            cached = json_load(self.app.get('/idx/?q=document').data)
+        self.assertEqual(cached, data)
+
+        with assert_query_count(3):
+            data = json_load(self.app.get('/documents/?q=hello').data)
+        with assert_query_count(0):
+            cached = json_load(self.app.get('/documents/?q=hello').data)
+        self.assertEqual(cached, data)
+
+        # Missing indexes are not cached.
+        for _ in range(2):
+            response = self.app.get('/missing/?q=document')
+            self.assertEqual(response.status_code, 404)
+
+        with assert_query_count(6):
+            self.app.get('/idx/?q=huey')
+
+        # HEAD and OPTIONS requests do not modify anything, so the cache is
+        # left intact.
+        self.assertEqual(self.app.head('/idx/?q=document').status_code, 200)
+        self.app.options('/idx/?q=document')
+        self.assertEqual(self.cache.client.get('scout:version'), None)
+
+        # Writes invalidate all cached responses.
+        response = self.app.post(
+            '/documents/',
+            data=json.dumps({'content': 'zaizee document', 'index': 'idx'}),
+            headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+        with assert_query_count(6):
+            data = json_load(self.app.get('/idx/?q=document').data)
+        self.assertEqual(len(data['documents']), 3)
+        self.assertEqual(self.cache.client.get('scout:version'), b'1')
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        if not database.is_closed():
+            database.close()
+        self.data_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.data_dir, 'scout.db')
+
+    def tearDown(self):
+        if not database.is_closed():
+            database.close()
+        database.init(test_config['DATABASE'],
+                      pragmas=test_config['SQLITE_PRAGMAS'])
+        shutil.rmtree(self.data_dir)
+
+    def test_attachment_length(self):
+        # Create an attachment as stored by older versions of Scout, which
+        # did not record the length of the data.
+        old_db = SqliteDatabase(self.filename)
+        old_db.execute_sql(
+            'CREATE TABLE "attachment" ("id" INTEGER NOT NULL PRIMARY KEY, '
+            '"document_id" INTEGER NOT NULL, "hash" TEXT NOT NULL, '
+            '"filename" TEXT NOT NULL, "mimetype" TEXT NOT NULL, '
+            '"timestamp" DATETIME NOT NULL)')
+        old_db.execute_sql(
+            'INSERT INTO "attachment" VALUES (1, 1, \'h\', \'a.txt\', '
+            '\'text/plain\', \'2020-01-01 00:00:00\')')
+        old_db.close()
+
+        server_app = create_server({'DATABASE': self.filename})
+        with database:
+            BlobData.create(hash='h', data=b'hello')
+            attachment = Attachment.get()
+            self.assertTrue(attachment.data_length is None)
+            self.assertEqual(attachment.length, 5)
+
+        client = server_app.test_client()
+        response = client.get('/documents/1/attachments/a.txt/download/')
+        self.assertEqual(response.data, b'hello')
+        self.assertEqual(response.headers['Content-Length'], '5')
+
+        # Running the migration again has no effect.
+        create_server({'DATABASE': self.filename})
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    # Use HTTP/1.1 so that connections are kept alive between requests.
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@unittest.skipIf(scout_client is None, 'scout_client is not importable')
+class TestClient(unittest.TestCase):
+    """
+    Exercise the Python client against a Scout server running in a
+    background thread. The server uses a database file, as every thread
+    would otherwise have its own in-memory database.
+    """
+    def setUp(self):
+        if not database.is_closed():
+            database.close()
+        self.data_dir = tempfile.mkdtemp()
+        server_app = create_server({
+            'DATABASE': os.path.join(self.data_dir, 'scout.db'),
+            'PAGINATE_BY': 10})
+        self.server = make_server('127.0.0.1', 0, server_app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = scout_client.Scout(
+            'http://127.0.0.1:%s/' % self.server.server_port)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if not database.is_closed():
+            database.close()
+        database.init(test_config['DATABASE'],
+                      pragmas=test_config['SQLITE_PRAGMAS'])
+        shutil.rmtree(self.data_dir)
+
+    def test_documents(self):
+        client = self.client
+        client.create_index('idx')
+        document = client.create_document(
+            'huey document',
+            'idx',
+            attachments={'a.txt': BytesIO(b'hello'), 'b.txt': b'world'},
+            k='v')
+        self.assertEqual(document['metadata'], {'k': 'v'})
+        self.assertEqual(
+            sorted(a['filename'] for a in document['attachments']),
+            ['a.txt', 'b.txt'])
+        self.assertEqual(client.download_attachment(document['id'], 'a.txt'),
+                         b'hello')
+        self.assertEqual(client.download_attachment(document['id'], 'b.txt'),
+                         b'world')
+
+        # Sequential requests share a single keep-alive connection.
+        conn, = client.pool._idle
+        client.get_document(document['id'])
+        self.assertEqual(client.pool._idle, [conn])
+
+        response = client.store_documents([
+            {'content': 'document %s' % i, 'indexes': 'idx'}
+            for i in range(15)])
+        self.assertEqual([d['content'] for d in response['documents']],
+                         ['document %s' % i for i in range(15)])
+
+        ids = [d['id'] for d in client.iter_documents(index='idx')]
+        self.assertEqual(ids, list(range(1, 17)))
+
+        results = client.search_many([
+            ('idx', {'q': 'huey'}),
+            ('idx', {'q': 'document', 'page': 2})])
+        self.assertEqual([r['filtered_count'] for r in results], [1, 16])
+        self.assertEqual([r['page'] for r in results], [1, 2])
+
+        with self.assertRaises(scout_client.HTTPError) as ctx:
+            client.get_document(100)
+        self.assertEqual(ctx.exception.code, 404)
+
+
+class FakeResponse(object):
+    reason = 'Reason'
+    msg = {}
+
+    def __init__(self, status):
+        self.status = status
+
+    def read(self):
+        return b'{}'
+
+
+class FakeConnection(object):
+    sock = None
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.closed = False
+
+    def request(self, method, url, body=None, headers=None):
+        self.requests.append(method)
+
+    def getresponse(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(scout_client is None, 'scout_client is not importable')
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = scout_client.ConnectionPool('http://localhost/',
+                                                backoff=0)
+
+    def test_stale_connection(self):
+        # If a re-used connection fails, a GET is sent again using a new
+        # connection.
+        stale = FakeConnection(socket.error('reset'))
+        conn = FakeConnection(200)
+        self.pool._idle.append(stale)
+        self.pool.connect = lambda: conn
+        response, data = self.pool.request('GET', '/')
+        self.assertEqual(response.status, 200)
+        self.assertTrue(stale.closed)
+        self.assertEqual(conn.requests, ['GET'])
+        self.assertEqual(self.pool._idle, [conn])
+
+        # The server may already have processed a POST, so it is not sent
+        # again.
+        stale = FakeConnection(socket.error('reset'))
+        self.pool._idle[:] = [stale]
+        self.assertRaises(socket.error, self.pool.request, 'POST', '/')
+        self.assertEqual(stale.requests, ['POST'])
+        self.assertEqual(conn.requests, ['GET'])
+        self.assertTrue(stale.closed)
+        self.assertEqual(self.pool._idle, [])
+
+        # A new connection which fails is closed and not returned to the
+        # pool.
+        conn = FakeConnection(socket.error('reset'))
+        self.pool.connect = lambda: conn
+        self.assertRaises(socket.error, self.pool.request, 'GET', '/')
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool._idle, [])
+
+    def test_retry_status(self):
+        conn = FakeConnection(503, 502, 200)
+        self.pool.connect = lambda: conn
+        response, data = self.pool.request('GET', '/')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(conn.requests, ['GET', 'GET', 'GET'])
+
+        conn.responses = [503]
+        conn.requests = []
+        with self.assertRaises(scout_client.HTTPError) as ctx:
+            self.pool.request('POST', '/')
+        self.assertEqual(ctx.exception.code, 503)
+        self.assertEqual(conn.requests, ['POST'])
+
+
 def main():
     option_parser = get_option_parser()
     options, args = option_parser.parse_args()
+    if options.parallel:
+        # Each worker is a separate process, and so has its own in-memory
+        # database.
+        try:
+            from importlib.util import find_spec
+            import pytest
+        except ImportError:
+            pytest = None
+        if pytest is None or find_spec('xdist') is None:
+            option_parser.error('--parallel requires pytest and pytest-xdist.')
+        argv = ['-n', 'auto', __file__]
+        if options.quiet:
+            argv.append('-q')
+        sys.exit(pytest.main(argv))
     unittest.main(argv=sys.argv, verbosity=not options.quiet and 2 or 0)
 
 
@@ -1,9 +1,15 @@
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = lambda maxsize: lambda fn: fn
 import json
 import sys
 
 from flask import request
 
 from scout.constants import PROTECTED_KEYS
+from scout.constants import RANKING_CHOICES
+from scout.constants import SEARCH_BM25
 from scout.exceptions import error
 from scout.models import Index
 
@@ -14,13 +20,37 @@ else:
     json_load = lambda d: json.loads(d.decode('utf-8') if isinstance(d, bytes)
                                      else d)
 
+# Values considered "not present" when validating POSTed data. This is kept
+# as a tuple, as values may be unhashable (e.g. metadata dicts or lists).
+EMPTY_VALUES = ('', None)
+
+
+@lru_cache(maxsize=256)
+def _parse_search_params(args):
+    # Memoized on the request arguments, given as a tuple of (key, values)
+    # 2-tuples, so the return value is built entirely from immutable types.
+    lookup = dict(args)
+    ranking = lookup.get('ranking', ('',))[0] or SEARCH_BM25
+    if ranking not in RANKING_CHOICES:
+        error('Unrecognized "ranking" value. Valid options are %s' %
+              ', '.join(sorted(RANKING_CHOICES)))
+
+    filters = tuple((key, values) for key, values in args
+                    if key not in PROTECTED_KEYS)
+    return ranking, lookup.get('ordering', ()), filters
+
 
 class RequestValidator(object):
-    def parse_post(self, required_keys=None, optional_keys=None):
+    def load_post_data(self):
         """
-        Clean and validate POSTed JSON data by defining sets of required and
-        optional keys.
+        Return the POSTed JSON data. The data is decoded once and cached for
+        the remainder of the request. The cache is stored in the request's
+        WSGI environ, as `g` may be shared by several requests if an
+        application context has already been pushed.
         """
+        if 'scout.post_data' in request.environ:
+            return request.environ['scout.post_data']
+
         if request.headers.get('content-type') == 'application/json':
             data = request.data
         elif 'data' not in request.form:
@@ -36,10 +66,37 @@ class RequestValidator(object):
         else:
             data = {}
 
-        required = set(required_keys or ())
-        optional = set(optional_keys or ())
-        all_keys = required | optional
-        keys_present = set(key for key in data if data[key] not in ('', None))
+        request.environ['scout.post_data'] = data
+        return data
+
+    def parse_post(self, required=frozenset(), optional=frozenset(),
+                   all_keys=None, nullable=frozenset()):
+        """
+        Clean and validate POSTed JSON data by defining sets of required and
+        optional keys. Callers should pass pre-built frozensets (and
+        optionally their union, `all_keys`) so no sets need to be constructed
+        on each request.
+
+        The returned dictionary only contains keys with non-empty values, so
+        callers can simply test for the presence of a key. Keys listed in
+        `nullable` are the exception: they are returned as-is, allowing an
+        empty value to signify that the field should be cleared.
+        """
+        return self.clean_data(self.load_post_data(), required, optional,
+                               all_keys, nullable)
+
+    def clean_data(self, data, required=frozenset(), optional=frozenset(),
+                   all_keys=None, nullable=frozenset()):
+        """
+        Clean and validate a dictionary of data, as described in
+        :py:meth:`parse_post`.
+        """
+        if not isinstance(data, dict):
+            error('Data must be a JSON object.')
+        if all_keys is None:
+            all_keys = required | optional
+        cleaned = {k: v for k, v in data.items() if v not in EMPTY_VALUES}
+        keys_present = cleaned.keys()
 
         missing = required - keys_present
         if missing:
@@ -49,19 +106,29 @@ class RequestValidator(object):
         if invalid_keys:
             error('Invalid keys: %s' % ', '.join(sorted(invalid_keys)))
 
-        return data
+        for key in nullable:
+            if key in data:
+                cleaned[key] = data[key]
+        return cleaned
 
-    def validate_indexes(self, data, required=True):
+    def get_index_names(self, data, required=True):
         if data.get('index'):
-            index_names = (data['index'],)
+            return (data['index'],)
         elif data.get('indexes'):
-            index_names = data['indexes']
+            return data['indexes']
         elif ('index' in data or 'indexes' in data) and not required:
             return ()
-        else:
-            return None
 
-        indexes = list(Index.select().where(Index.name << index_names))
+    def validate_indexes(self, data, required=True):
+        index_names = self.get_index_names(data, required)
+        if not index_names:
+            return index_names
+
+        if len(index_names) == 1:
+            index = Index.get_or_none(Index.name == index_names[0])
+            indexes = [index] if index is not None else []
+        else:
+            indexes = list(Index.select().where(Index.name << index_names))
 
         # Validate that all the index names exist.
         observed_names = set(index.name for index in indexes)
@@ -76,8 +143,36 @@ class RequestValidator(object):
 
         return indexes
 
-    def extract_get_params(self):
-        return dict(
-            (key, request.args.getlist(key))
-            for key in request.args
-            if key not in PROTECTED_KEYS)
+    def validate_batch_indexes(self, items):
+        """
+        Validate the indexes specified by each item in a batch, returning a
+        list of indexes for every item. The indexes for the entire batch are
+        fetched with a single query.
+        """
+        names_list = []
+        for data in items:
+            index_names = self.get_index_names(data)
+            if not index_names:
+                error('You must specify either an "index" or "indexes".')
+            names_list.append(index_names)
+
+        all_names = set(name for names in names_list for name in names)
+        index_map = dict((index.name, index) for index in Index.select().where(
+            Index.name << list(all_names)))
+
+        invalid_names = sorted(all_names - set(index_map))
+        if invalid_names:
+            error('The following indexes were not found: %s.' %
+                  ', '.join(invalid_names))
+
+        return [[index_map[name] for name in names] for names in names_list]
+
+    def extract_search_params(self):
+        """
+        Return the ranking, ordering and metadata filters for the current
+        search request.
+        """
+        ranking, ordering, filters = _parse_search_params(tuple(
+            (key, tuple(values)) for key, values in request.args.lists()))
+        return (ranking, list(ordering),
+                {key: list(values) for key, values in filters})
@@ -1,22 +1,29 @@
+import base64
 from functools import wraps
+import hmac
+import json
 import logging
+import os
 
 from flask import abort
+from flask import current_app
 from flask import Flask
 from flask import jsonify
-from flask import make_response
 from flask import request
 from flask import Response
 from flask import url_for
 from flask.views import MethodView
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
 from peewee import *
 from playhouse.flask_utils import get_object_or_404
 from playhouse.flask_utils import PaginatedQuery
-from werkzeug.exceptions import NotFound
 
+from scout.cache import SearchCache
 from scout.constants import PROTECTED_KEYS
-from scout.constants import RANKING_CHOICES
-from scout.constants import SEARCH_BM25
+from scout.constants import SEARCH_NONE
 from scout.exceptions import error
 from scout.models import database
 from scout.models import Attachment
@@ -24,11 +31,12 @@ from scout.models import BlobData
 from scout.models import Document
 from scout.models import Index
 from scout.models import IndexDocument
-from scout.models import Metadata
+from scout.models import unicode_type
 from scout.search import DocumentSearch
 from scout.serializers import AttachmentSerializer
 from scout.serializers import DocumentSerializer
 from scout.serializers import IndexSerializer
+from scout.serializers import OrjsonProvider
 from scout.validator import RequestValidator
 
 
@@ -47,6 +55,34 @@ def register_views(app):
     if prefix:
         prefix = '/%s' % prefix.strip('/')
 
+    # Use orjson for encoding responses, if it is installed.
+    if OrjsonProvider is not None:
+        app.json = OrjsonProvider(app)
+
+    # Compress large JSON responses if Flask-Compress is installed.
+    if Compress is not None:
+        app.config.setdefault('COMPRESS_MIMETYPES', ['application/json'])
+        app.config.setdefault('COMPRESS_ALGORITHM', ['br', 'gzip'])
+        app.config.setdefault('COMPRESS_BR_LEVEL', 4)
+        app.config.setdefault('COMPRESS_LEVEL', 4)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+        Compress(app)
+
+    # Cache search responses if a cache has been configured (or one has
+    # already been installed on the app). Any successful write request
+    # invalidates all cached responses.
+    search_cache = app.extensions.get('scout_search_cache')
+    if search_cache is None:
+        search_cache = SearchCache.from_config(app.config)
+        app.extensions['scout_search_cache'] = search_cache
+    if search_cache is not None:
+        @app.after_request
+        def invalidate_search_cache(response):
+            if (request.method in ('POST', 'PUT', 'DELETE') and
+                    response.status_code < 400):
+                search_cache.invalidate()
+            return response
+
     # Register views and request handlers.
     index_view = IndexView(app)
     index_view.register('index_view', '%s/' % prefix)
@@ -59,6 +95,14 @@ def register_views(app):
         'attachment_view',
         '%s/documents/<document_id>/attachments/' % prefix,
         'path')
+    # The batch URL is not beneath /documents/, where it would shadow a
+    # document whose identifier is "batch".
+    app.add_url_rule(
+        '%s/batch/documents/' % prefix,
+        'document_view_batch',
+        view_func=authentication(app)(document_view.batch_create),
+        methods=['POST'])
+
     app.add_url_rule(
         '%s/documents/<document_id>/attachments/<path:pk>/download/' % prefix,
         view_func=authentication(app)(attachment_download))
@@ -74,7 +118,7 @@ def authentication(app):
 
             # Check headers and request.args for `key=<key>`.
             key = request.headers.get('key') or request.args.get('key')
-            if key != api_key:
+            if not constant_time_compare(key or '', api_key):
                 logger.info('Authentication failure for key: %s', key)
                 return 'Invalid API key', 401
             else:
@@ -83,20 +127,89 @@ def authentication(app):
     return decorator
 
 
+def constant_time_compare(s1, s2):
+    if not isinstance(s1, bytes):
+        s1 = s1.encode('utf-8')
+    if not isinstance(s2, bytes):
+        s2 = s2.encode('utf-8')
+    return hmac.compare_digest(s1, s2)
+
+
+class KeysetPaginatedQuery(object):
+    """
+    Paginate a query by seeking past the last row of the previous page rather
+    than using an OFFSET, so that fetching deep pages does not require the
+    database to scan all of the preceding rows.
+
+    The query is ordered by `keys`, a sequence of (expression, attribute)
+    2-tuples which together must uniquely identify a row. The values of the
+    last row on the page are encoded in an opaque cursor, which is used to
+    request the next page.
+    """
+    def __init__(self, query, keys, paginate_by, cursor=None):
+        self.keys = keys
+        self.paginate_by = paginate_by
+
+        expressions = [expression for expression, _ in keys]
+        query = query.order_by(*expressions)
+        if cursor:
+            values = self.decode_cursor(cursor)
+            query = query.where(Tuple(*expressions) > Tuple(*values))
+
+        # Fetch one additional row to determine if there is a next page.
+        self.query = query.limit(paginate_by + 1)
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(
+                cursor.encode('utf-8')).decode('utf-8'))
+        except (TypeError, ValueError):
+            values = None
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            error('Invalid cursor.')
+        # Only scalar values are passed to the database as parameters.
+        for value in values:
+            if not isinstance(value, (unicode_type, int, float)):
+                error('Invalid cursor.')
+        return values
+
+    def encode_cursor(self, values):
+        return base64.urlsafe_b64encode(
+            json.dumps(values).encode('utf-8')).decode('utf-8')
+
+    def get_object_list(self):
+        return list(self.query)[:self.paginate_by]
+
+    def get_next_cursor(self, rows=None):
+        """
+        Return the cursor for the next page, or `None` if this is the last
+        page. If the rows (model instances or dicts) have already been
+        fetched, they can be passed in to avoid evaluating the query again.
+        """
+        if rows is None:
+            rows = list(self.query)
+        if len(rows) > self.paginate_by:
+            last = rows[self.paginate_by - 1]
+            if isinstance(last, dict):
+                values = [last[attr] for _, attr in self.keys]
+            else:
+                values = [getattr(last, attr) for _, attr in self.keys]
+            return self.encode_cursor(values)
+
+
 class ScoutView(object):
     def __init__(self, app):
         self.app = app
         self.paginate_by = app.config.get('PAGINATE_BY') or 50
+        self.search_cache = app.extensions.get('scout_search_cache')
 
     def register(self, name, url, pk_type=None):
         auth = authentication(self.app)
-        base_views = (
-            (self.list_view, 'GET', name),
-            (self.create, 'POST', name + '_create'))
 
-        for view, method, view_name in base_views:
-            self.app.add_url_rule(url, view_name, view_func=auth(view),
-                                  methods=[method])
+        # A single rule serves both listing (GET) and creation (POST), which
+        # keeps the URL map small.
+        self.app.add_url_rule(url, name, view_func=auth(self.list_or_create),
+                              methods=['GET', 'POST'])
 
         if pk_type is None:
             detail_url = url + '<pk>/'
@@ -113,12 +226,41 @@ class ScoutView(object):
             self.app.add_url_rule(detail_url, view_name, view_func=auth(view),
                                   methods=methods)
 
+    def list_or_create(self, *args, **kwargs):
+        if request.method == 'POST':
+            return self.create(*args, **kwargs)
+        return self.list_view(*args, **kwargs)
+
     def paginated_query(self, query, paginate_by=None):
         return PaginatedQuery(
             query,
             paginate_by=paginate_by or self.paginate_by,
             check_bounds=False)
 
+    def keyset_query(self, query, keys, ordering):
+        """
+        Return a :py:class:`KeysetPaginatedQuery` if the client requested
+        cursor-based pagination by specifying a `cursor`, otherwise `None`.
+        """
+        if 'cursor' not in request.args:
+            return None
+        elif ordering:
+            error('The "ordering" parameter cannot be used with "cursor".')
+        return KeysetPaginatedQuery(
+            query,
+            keys,
+            self.paginate_by,
+            request.args['cursor'])
+
+    def conditional_response(self, data):
+        """
+        Return a JSON response with an ETag, or an empty 304 response if the
+        client already has an identical copy (`If-None-Match`).
+        """
+        response = jsonify(data)
+        response.add_etag()
+        return response.make_conditional(request)
+
     def detail(self):
         raise NotImplementedError
 
@@ -134,33 +276,84 @@ class ScoutView(object):
     def delete(self):
         raise NotImplementedError
 
-    def _search_response(self, index, allow_blank, document_count):
-        ranking = request.args.get('ranking') or SEARCH_BM25
-        if ranking not in RANKING_CHOICES:
-            error('Unrecognized "ranking" value. Valid options are %s' %
-                  ', '.join(RANKING_CHOICES))
+    def _search_response(self, search):
+        """
+        Return the response generated by the `search` callable, which is
+        cached if a search cache is configured. All the queries needed to
+        build the response are performed by `search`, so a cached response
+        can be returned without querying the database.
+        """
+        if self.search_cache is None:
+            return search()
+
+        key = self.search_cache.make_key(
+            request.path,
+            sorted(request.args.items(multi=True)))
+        response = self.search_cache.get(key)
+        if response is None:
+            response = search()
+            self.search_cache.set(key, response)
+        return response
 
-        ordering = request.args.getlist('ordering')
-        filters = validator.extract_get_params()
+    def _search(self, index, allow_blank, document_count):
+        ranking, ordering, filters = validator.extract_search_params()
 
         q = request.args.get('q', '').strip()
         if not q and not allow_blank:
             error('Search term is required.')
 
         query = engine.search(q or '*', index, ranking, ordering, **filters)
-        pq = self.paginated_query(query)
+        include_score = True if q else False
+
+        # Ranked results are ordered by score, using the docid to break ties.
+        keys = [(Document.docid, 'docid')]
+        if q and ranking != SEARCH_NONE:
+            keys.insert(0, (engine.get_rank_expression(ranking), 'score'))
 
         response = {
             'document_count': document_count,
-            'documents': document_serializer.serialize_query(
-                pq.get_object_list(),
-                include_score=True if q else False),
-            'filtered_count': query.count(),
             'filters': filters,
             'ordering': ordering,
-            'page': pq.get_page(),
-            'pages': pq.get_page_count(),
         }
+
+        # A blank search without any filters matches every document in the
+        # index (or every document), so the count is already known.
+        if not q and not filters and not isinstance(index, Select):
+            filtered_count = document_count
+        else:
+            filtered_count = None
+
+        kq = self.keyset_query(query, keys, ordering)
+        if kq is not None:
+            # Cursor pagination does not need to know the number of pages, so
+            # the (potentially expensive) COUNT query is only performed when
+            # the client asks for it.
+            if request.args.get('with_count') in ('1', 'true'):
+                if filtered_count is None:
+                    filtered_count = query.count()
+                response['filtered_count'] = filtered_count
+            # The rows are fetched once, and the extra row used to detect
+            # the next page is not serialized.
+            rows = list(kq.query.dicts())
+            response.update(
+                documents=document_serializer.serialize_query(
+                    rows[:kq.paginate_by],
+                    include_score=include_score),
+                next_cursor=kq.get_next_cursor(rows))
+        else:
+            # The filtered count is also used to determine the number of
+            # pages, rather than having the paginator issue a second COUNT.
+            if filtered_count is None:
+                filtered_count = query.count()
+            pq = self.paginated_query(query)
+            response.update(
+                documents=document_serializer.serialize_query(
+                    pq.get_object_list(),
+                    include_score=include_score),
+                filtered_count=filtered_count,
+                page=pq.get_page(),
+                pages=-(-filtered_count // pq.paginate_by))
+
         if q:
             response.update(
                 ranking=ranking,
@@ -172,29 +365,47 @@ class ScoutView(object):
 #
 
 class IndexView(ScoutView):
+    REQUIRED = frozenset(('name',))
+    SORT_OPTIONS = {
+        'name': Index.name,
+        'document_count': SQL('document_count'),
+        'id': Index.id,
+    }
+
+    def _get_query(self):
+        # Annotate each index with the number of documents it contains.
+        return (Index
+                .select(
+                    Index,
+                    fn.COUNT(IndexDocument.id).alias('document_count'))
+                .join(IndexDocument, JOIN.LEFT_OUTER)
+                .group_by(Index))
+
     def detail(self, pk):
-        index = get_object_or_404(Index, Index.name == pk)
-        document_count = index.documents.count()
-        response = {'name': index.name, 'id': index.id}
-        response.update(self._search_response(index, True, document_count))
-        return jsonify(response)
+        def search():
+            index = get_object_or_404(self._get_query(), Index.name == pk)
+            response = {'name': index.name, 'id': index.id}
+            response.update(self._search(index, True, index.document_count))
+            return response
+        return jsonify(self._search_response(search))
 
     def list_view(self):
-        query = (Index
-                 .select(
-                     Index,
-                     fn.COUNT(IndexDocument.id).alias('document_count'))
-                 .join(IndexDocument, JOIN.LEFT_OUTER)
-                 .group_by(Index))
+        query = self._get_query()
 
         ordering = request.args.getlist('ordering')
-        query = engine.apply_sorting(query, ordering, {
-            'name': Index.name,
-            'document_count': SQL('document_count'),
-            'id': Index.id}, 'name')
+        query = engine.apply_sorting(query, ordering, self.SORT_OPTIONS,
+                                     'name')
+
+        kq = self.keyset_query(query, [(Index.name, 'name')], ordering)
+        if kq is not None:
+            return self.conditional_response({
+                'indexes': [index_serializer.serialize(index)
+                            for index in kq.get_object_list()],
+                'next_cursor': kq.get_next_cursor(),
+                'ordering': ordering})
 
         pq = self.paginated_query(query)
-        return jsonify({
+        return self.conditional_response({
             'indexes': [index_serializer.serialize(index)
                         for index in pq.get_object_list()],
             'ordering': ordering,
@@ -202,7 +413,7 @@ class IndexView(ScoutView):
             'pages': pq.get_page_count()})
 
     def create(self):
-        data = validator.parse_post(['name'])
+        data = validator.parse_post(self.REQUIRED)
 
         with database.atomic():
             try:
@@ -216,7 +427,7 @@ class IndexView(ScoutView):
 
     def update(self, pk):
         index = get_object_or_404(Index, Index.name == pk)
-        data = validator.parse_post(['name'])
+        data = validator.parse_post(self.REQUIRED)
         index.name = data['name']
 
         with database.atomic():
@@ -246,27 +457,65 @@ class IndexView(ScoutView):
 
 
 class _FileProcessingView(ScoutView):
-    def _get_document(self, pk):
+    def _find_document(self, pk):
+        """
+        Look up a document by id or identifier, returning `None` if no
+        matching document exists.
+        """
+        # Documents are cached for the duration of the request, as several
+        # handlers look up the same document more than once. The cache is
+        # stored in the request's WSGI environ rather than `g`, which may be
+        # shared by several requests.
+        cache = request.environ.setdefault('scout.documents', {})
+        if pk in cache:
+            return cache[pk]
+
+        document = None
         if isinstance(pk, int) or (pk and pk.isdigit()):
-            query = Document.all().where(Document._meta.primary_key == pk)
-            try:
-                return query.get()
-            except Document.DoesNotExist:
-                pass
-        return get_object_or_404(Document.all(), Document.identifier == pk)
+            document = (Document
+                        .all()
+                        .where(Document._meta.primary_key == pk)
+                        .first())
+        if document is None:
+            document = (Document
+                        .all()
+                        .where(Document.identifier == pk)
+                        .first())
+
+        if document is not None:
+            cache[pk] = document
+        return document
+
+    def _get_document(self, pk):
+        document = self._find_document(pk)
+        if document is None:
+            abort(404)
+        return document
 
     def attach_files(self, document):
-        attachments = []
-        for identifier in request.files:
-            file_obj = request.files[identifier]
-            attachments.append(
-                document.attach(file_obj.filename, file_obj.read()))
+        blob_directory = self.app.config.get('BLOB_DIRECTORY')
+        attachments = document.attach_many([
+            (request.files[identifier].filename,
+             request.files[identifier].stream)
+            for identifier in request.files])
+        for attachment in attachments:
+            if blob_directory:
+                # The attachments are selected along with their compressed
+                # data, so the blob does not need to be read again.
+                BlobData.export(attachment.hash, blob_directory,
+                                attachment.compressed)
             logger.info('Attached %s to document id = %s',
-                        file_obj.filename, document.get_id())
+                        attachment.filename, document.get_id())
         return attachments
 
 
 class DocumentView(_FileProcessingView):
+    CREATE_REQUIRED = frozenset(('content',))
+    CREATE_OPTIONAL = frozenset(('identifier', 'index', 'indexes', 'metadata'))
+    UPDATE_ALL_KEYS = CREATE_REQUIRED | CREATE_OPTIONAL
+    UPDATE_NULLABLE = frozenset(('index', 'indexes', 'metadata'))
+    BATCH_REQUIRED = frozenset(('documents',))
+
     def detail(self, pk):
         document = self._get_document(pk)
         return jsonify(document_serializer.serialize(document))
@@ -279,26 +528,85 @@ class DocumentView(_FileProcessingView):
         else:
             indexes = None
 
-        document_count = Document.select().count()
-        return jsonify(self._search_response(indexes, True, document_count))
+        def search():
+            document_count = Document.select().count()
+            return self._search(indexes, True, document_count)
+        return jsonify(self._search_response(search))
 
     def create(self):
         data = validator.parse_post(
-            ['content'],
-            ['identifier', 'index', 'indexes', 'metadata'])
+            self.CREATE_REQUIRED,
+            self.CREATE_OPTIONAL,
+            self.UPDATE_ALL_KEYS,
+            self.UPDATE_NULLABLE)
 
         indexes = validator.validate_indexes(data)
         if indexes is None:
             error('You must specify either an "index" or "indexes".')
 
-        if data.get('identifier'):
-            try:
-                document = self._get_document(data['identifier'])
-            except NotFound:
-                pass
-            else:
-                return self.update(data['identifier'])
+        if 'identifier' in data:
+            document = self._find_document(data['identifier'])
+            if document is not None:
+                return self._update(document, data, indexes)
+
+        document = self._create(data, indexes)
+        if len(request.files):
+            self.attach_files(document)
 
+        return self.detail(document.get_id())
+
+    def batch_create(self):
+        """
+        Create (or update, if the identifier already exists) any number of
+        documents using a single request and a single transaction.
+        """
+        # Any files would otherwise be attached to only those documents
+        # which already exist.
+        if request.files:
+            error('Files cannot be attached to a batch of documents.')
+
+        data = validator.parse_post(self.BATCH_REQUIRED)
+        items = data['documents']
+        if not isinstance(items, list):
+            error('"documents" must be a list.')
+
+        # Each document is bound as a parameter of the IN queries used to
+        # look up and serialize the batch, and SQLite limits the number of
+        # parameters a query may have.
+        max_documents = self.app.config.get('BATCH_MAX_DOCUMENTS') or 500
+        if len(items) > max_documents:
+            error('A batch may contain at most %s documents.' % max_documents)
+
+        items = [validator.clean_data(
+                     item,
+                     self.CREATE_REQUIRED,
+                     self.CREATE_OPTIONAL,
+                     self.UPDATE_ALL_KEYS,
+                     self.UPDATE_NULLABLE)
+                 for item in items]
+        item_indexes = validator.validate_batch_indexes(items)
+
+        docids = []
+        with database.atomic():
+            for data, indexes in zip(items, item_indexes):
+                document = None
+                if 'identifier' in data:
+                    document = self._find_document(data['identifier'])
+                if document is None:
+                    document = self._create(data, indexes)
+                else:
+                    self._apply_update(document, data, indexes)
+                docids.append(document.get_id())
+
+        if not docids:
+            return jsonify({'documents': []})
+
+        documents = dict((document['id'], document) for document in
+                         document_serializer.serialize_query(
+                             Document.all().where(Document.docid << docids)))
+        return jsonify({'documents': [documents[docid] for docid in docids]})
+
+    def _create(self, data, indexes):
         document = Document.create(
             content=data['content'],
             identifier=data.get('identifier'))
@@ -313,25 +621,30 @@ class DocumentView(_FileProcessingView):
             logger.info('Added document %s to index %s',
                         document.get_id(), index.name)
 
-        if len(request.files):
-            self.attach_files(document)
-
-        return self.detail(document.get_id())
+        return document
 
     def update(self, pk):
         document = self._get_document(pk)
-        data = validator.parse_post([], [
-            'content',
-            'identifier',
-            'index',
-            'indexes',
-            'metadata'])
+        data = validator.parse_post(
+            optional=self.UPDATE_ALL_KEYS,
+            all_keys=self.UPDATE_ALL_KEYS,
+            nullable=self.UPDATE_NULLABLE)
+        return self._update(document, data)
+
+    def _update(self, document, data, indexes=None):
+        # Perform all the changes in a single transaction, so a failure
+        # (e.g. an invalid index name) does not leave a partial update.
+        with database.atomic():
+            self._apply_update(document, data, indexes)
 
+        return jsonify(document_serializer.serialize(document))
+
+    def _apply_update(self, document, data, indexes=None):
         save_document = False
-        if data.get('content'):
+        if 'content' in data:
             document.content = data['content']
             save_document = True
-        if data.get('identifier'):
+        if 'identifier' in data:
             document.identifier = data['identifier']
             save_document = True
 
@@ -347,41 +660,45 @@ class DocumentView(_FileProcessingView):
         if len(request.files):
             self.attach_files(document)
 
-        indexes = validator.validate_indexes(data, required=False)
+        if indexes is None:
+            indexes = validator.validate_indexes(data, required=False)
         if indexes is not None:
-            with database.atomic():
+            # Add any new index memberships (existing rows are left alone)
+            # and then remove the memberships that are no longer wanted.
+            index_ids = [index.id for index in indexes]
+            delete = (IndexDocument
+                      .delete()
+                      .where(IndexDocument.document == document))
+            if index_ids:
                 (IndexDocument
-                 .delete()
-                 .where(IndexDocument.document == document)
+                 .insert_many([
+                     {'index': index_id, 'document': document}
+                     for index_id in index_ids])
+                 .on_conflict_ignore()
                  .execute())
-
-                if indexes:
-                    IndexDocument.insert_many([
-                        {'index': index, 'document': document}
-                        for index in indexes]).execute()
-
-        return self.detail(document.get_id())
+                delete = delete.where(
+                    IndexDocument.index.not_in(index_ids))
+            delete.execute()
 
     def delete(self, pk):
         document = self._get_document(pk)
 
-        with database.atomic():
-            (IndexDocument
-             .delete()
-             .where(IndexDocument.document == document)
-             .execute())
-            (Attachment
-             .delete()
-             .where(Attachment.document == document)
-             .execute())
-            Metadata.delete().where(Metadata.document == document).execute()
-            document.delete_instance()
-            logger.info('Deleted document with id = %s', document.get_id())
+        document.delete_instance()
+        logger.info('Deleted document with id = %s', document.get_id())
 
         return jsonify({'success': True})
 
 
 class AttachmentView(_FileProcessingView):
+    SORT_OPTIONS = {
+        'document': Attachment.document,
+        'hash': Attachment.hash,
+        'filename': Attachment.filename,
+        'mimetype': Attachment.mimetype,
+        'timestamp': Attachment.timestamp,
+        'id': Attachment.id,
+    }
+
     def _get_attachment(self, document, pk):
         return get_object_or_404(
             document.attachments,
@@ -394,25 +711,25 @@ class AttachmentView(_FileProcessingView):
 
     def list_view(self, document_id):
         document = self._get_document(document_id)
-        query = (Attachment
-                 .select(Attachment, BlobData)
-                 .join(
-                     BlobData,
-                     on=(Attachment.hash == BlobData.hash).alias('_blob'))
-                 .where(Attachment.document == document))
+        query = Attachment.select().where(Attachment.document == document)
 
         ordering = request.args.getlist('ordering')
-        query = engine.apply_rank_and_sort(query, None, ordering, {
-            'document': Attachment.document,
-            'hash': Attachment.hash,
-            'filename': Attachment.filename,
-            'mimetype': Attachment.mimetype,
-            'timestamp': Attachment.timestamp,
-            'id': Attachment.id,
-        }, 'filename')
+        query = engine.apply_rank_and_sort(query, None, ordering,
+                                           self.SORT_OPTIONS, 'filename')
+
+        kq = self.keyset_query(
+            query,
+            [(Attachment.filename, 'filename')],
+            ordering)
+        if kq is not None:
+            return self.conditional_response({
+                'attachments': [attachment_serializer.serialize(attachment)
+                                for attachment in kq.get_object_list()],
+                'next_cursor': kq.get_next_cursor(),
+                'ordering': ordering})
 
         pq = self.paginated_query(query)
-        return jsonify({
+        return self.conditional_response({
             'attachments': [attachment_serializer.serialize(attachment)
                             for attachment in pq.get_object_list()],
             'ordering': ordering,
@@ -421,7 +738,7 @@ class AttachmentView(_FileProcessingView):
 
     def create(self, document_id):
         document = self._get_document(document_id)
-        validator.parse_post([], [])  # Ensure POST data is clean.
+        validator.parse_post()  # Ensure POST data is clean.
 
         if len(request.files):
             attachments = self.attach_files(document)
@@ -435,7 +752,7 @@ class AttachmentView(_FileProcessingView):
     def update(self, document_id, pk):
         document = self._get_document(document_id)
         attachment = self._get_attachment(document, pk)
-        validator.parse_post([], [])  # Ensure POST data is clean.
+        validator.parse_post()  # Ensure POST data is clean.
 
         nfiles = len(request.files)
         if nfiles == 1:
@@ -456,14 +773,45 @@ class AttachmentView(_FileProcessingView):
 
 
 def attachment_download(document_id, pk):
-    document = get_object_or_404(
-        Document.all(),
-        Document._meta.primary_key == document_id)
+    # If attachment data is exported to the filesystem, let the front-end
+    # server (e.g. Nginx) send the file using X-Accel-Redirect.
+    redirect_prefix = current_app.config.get('X_ACCEL_REDIRECT_PREFIX')
+    blob_directory = current_app.config.get('BLOB_DIRECTORY')
+    if redirect_prefix and blob_directory:
+        attachment = get_object_or_404(
+            Attachment.select(
+                Attachment.filename,
+                Attachment.hash,
+                Attachment.mimetype),
+            (Attachment.document == document_id) &
+            (Attachment.filename == pk))
+        filename = BlobData.get_filename(attachment.hash)
+        if os.path.exists(os.path.join(blob_directory, filename)):
+            response = Response()
+            response.headers['Content-Type'] = attachment.mimetype
+            response.headers['Content-Disposition'] = (
+                'inline; filename=%s' % attachment.filename)
+            response.headers['X-Accel-Redirect'] = '%s/%s' % (
+                redirect_prefix.rstrip('/'),
+                filename)
+            return response
+
+    # Select the compressed data, which is decompressed in chunks as the
+    # response is streamed, rather than being held in memory all at once.
+    query = (Attachment
+             .select(
+                 Attachment.filename,
+                 Attachment.mimetype,
+                 Attachment.data_length,
+                 BlobData.data.cast('BLOB').alias('compressed'))
+             .join(BlobData, on=(Attachment.hash == BlobData.hash))
+             .objects())
     attachment = get_object_or_404(
-        document.attachments,
-        Attachment.filename == pk)
+        query,
+        (Attachment.document == document_id) &
+        (Attachment.filename == pk))
 
-    response = make_response(attachment.blob.data)
+    response = Response(BlobData.iter_decompress(attachment.compressed))
     response.headers['Content-Type'] = attachment.mimetype
     response.headers['Content-Length'] = attachment.length
     response.headers['Content-Disposition'] = 'inline; filename=%s' % (
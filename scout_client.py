@@ -1,50 +1,316 @@
 import base64
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 import json
 try:
     from email.generator import _make_boundary as choose_boundary
 except ImportError:
     from mimetools import choose_boundary
+try:
+    from http.client import HTTPConnection
+    from http.client import HTTPException
+    from http.client import HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection
+    from httplib import HTTPException
+    from httplib import HTTPSConnection
+from io import BytesIO
 import mimetypes
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import os
+import select
+import socket
+import sys
+import threading
+import time
 try:
+    from urllib.error import HTTPError
     from urllib.parse import urlencode
+    from urllib.parse import urlsplit
 except ImportError:
     from urllib import urlencode
-try:
-    from urllib.request import Request
-    from urllib.request import urlopen
-except ImportError:
-    from urllib2 import Request
-    from urllib2 import urlopen
+    from urllib2 import HTTPError
+    from urlparse import urlsplit
 import zlib
 
 
 ENDPOINT = None
 KEY = None
 
+# Size of the chunks read from files when uploading attachments.
+CHUNK_SIZE = 64 * 1024
+
+
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(data):
+        data = json.dumps(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    if sys.version_info[:2] < (3, 6) and sys.version_info[0] != 2:
+        def json_loads(data):
+            return json.loads(data.decode('utf-8'))
+    else:
+        # The response body can be parsed without first decoding it.
+        json_loads = json.loads
+
+
+def _as_list(value):
+    # Allow a single index name to be passed in place of a list of names.
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent connections to a single server, allowing
+    requests to re-use an existing connection (HTTP keep-alive) rather than
+    establishing a new one for every call.
+    """
+    retry_methods = frozenset(('GET', 'HEAD'))
+    retry_statuses = frozenset((502, 503, 504))
+
+    def __init__(self, endpoint, maxsize=8, timeout=None, retries=3,
+                 backoff=0.1):
+        parsed = urlsplit(endpoint)
+        if parsed.scheme == 'https':
+            self.connection_class = HTTPSConnection
+        else:
+            self.connection_class = HTTPConnection
+        self.host = parsed.netloc
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self.timeout is None:
+            return self.connection_class(self.host)
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _is_dropped(self, conn):
+        # An idle connection has nothing to read, so if its socket is
+        # readable, the server has closed it.
+        if conn.sock is None:
+            return False
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (socket.error, ValueError):
+            return True
+
+    def _get_connection(self):
+        """
+        Return a 2-tuple of a connection and a boolean indicating whether it
+        was re-used from the pool.
+        """
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self.connect(), False
+            elif not self._is_dropped(conn):
+                return conn, True
+            conn.close()
+
+    def _request(self, method, url, body, headers):
+        conn, reused = self._get_connection()
+        try:
+            try:
+                conn.request(method, url, body, headers)
+            except (socket.error, HTTPException):
+                if not reused:
+                    raise
+                # The request was not sent in full, so the server cannot have
+                # acted upon it, and it is safe to send it again.
+                conn.close()
+                conn, reused = self.connect(), False
+                conn.request(method, url, body, headers)
+
+            try:
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, HTTPException):
+                # The server may have closed the connection after receiving
+                # the request. Only requests which can safely be performed
+                # twice are sent again.
+                if not reused or method not in self.retry_methods:
+                    raise
+                conn.close()
+                conn = self.connect()
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        self.release(conn)
+        return response, data
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Perform a request, returning a 2-tuple of the response object and the
+        response body. Idempotent requests that fail with a 502, 503 or 504
+        are retried, waiting a little longer each time. Raises an `HTTPError`
+        for 4xx and 5xx responses.
+        """
+        headers = headers or {}
+        attempt = 0
+        while True:
+            response, data = self._request(method, url, body, headers)
+            if (attempt >= self.retries or
+                    method not in self.retry_methods or
+                    response.status not in self.retry_statuses):
+                break
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, BytesIO(data))
+        return response, data
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(endpoint, maxsize=8, timeout=None):
+    """
+    Return the connection pool for the server at the given endpoint. Clients
+    talking to the same server share a pool, and hence their connections.
+    """
+    parsed = urlsplit(endpoint)
+    key = (parsed.scheme, parsed.netloc, timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(endpoint, maxsize, timeout)
+        else:
+            pool.maxsize = max(pool.maxsize, maxsize)
+    return pool
+
+
+class MultipartBody(object):
+    """
+    Iterable multipart/form-data request body. Rather than reading the files
+    into memory, their contents are read in chunks as the body is sent.
+    Iterating over the body again (e.g. when a request is retried) re-reads
+    the files from the position they were at initially.
+    """
+    def __init__(self, boundary, json_data, files):
+        self.boundary = boundary
+        self.segments = []
+        self.add_part('Content-Disposition: form-data; name="data"',
+                      json_dumps(json_data))
+        for i, (filename, file_obj) in enumerate(files.items()):
+            mimetype = (mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream')
+            self.add_part(
+                'Content-Disposition: file; name="file_%s"; filename="%s"\r\n'
+                'Content-Type: %s' % (i, filename, mimetype),
+                self.get_file_segment(file_obj))
+        self.segments.append(('--%s--\r\n' % boundary).encode('utf-8'))
+
+    def add_part(self, headers, data):
+        self.segments.append(
+            ('--%s\r\n%s\r\n\r\n' % (self.boundary, headers)).encode('utf-8'))
+        self.segments.append(data)
+        self.segments.append(b'\r\n')
+
+    def get_file_segment(self, file_obj):
+        if not hasattr(file_obj, 'read'):
+            return bytes(file_obj)
+        try:
+            start = file_obj.tell()
+            file_obj.seek(0, os.SEEK_END)
+            length = file_obj.tell() - start
+            file_obj.seek(start)
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not seekable, so the contents must be read into memory.
+            data = file_obj.read()
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            return data
+        return (file_obj, start, length)
+
+    def __len__(self):
+        return sum(len(segment) if isinstance(segment, bytes) else segment[2]
+                   for segment in self.segments)
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            file_obj, start, remaining = segment
+            file_obj.seek(start)
+            while remaining > 0:
+                chunk = file_obj.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode('utf-8')
+                remaining -= len(chunk)
+                yield chunk
+
 
 class Scout(object):
-    def __init__(self, endpoint=ENDPOINT, key=KEY):
+    def __init__(self, endpoint=ENDPOINT, key=KEY, pool_size=16,
+                 timeout=None):
         self.endpoint = endpoint.rstrip('/')
         self.key = key
+        self.path = urlsplit(self.endpoint).path
+        self.pool = get_pool(self.endpoint, pool_size, timeout)
+
+        # The headers are the same for every request, so build them once.
+        self._key_headers = {'key': key} if key else {}
+        self._json_headers = {'Content-Type': 'application/json'}
+        self._json_headers.update(self._key_headers)
 
     def get_full_url(self, url):
         return self.endpoint + url
 
+    def close(self):
+        self.pool.close()
+
+    def request(self, method, url, body=None, headers=None):
+        return self.pool.request(method, self.path + url, body, headers)[1]
+
     def get_raw(self, url, **kwargs):
-        headers = {'Content-Type': 'application/json'}
-        if self.key:
-            headers['key'] = self.key
         if kwargs:
             if '?' not in url:
                 url += '?'
             url += urlencode(kwargs, True)
-        request = Request(self.get_full_url(url), headers=headers)
-        fh = urlopen(request)
-        return fh.read()
+        return self.request('GET', url, headers=self._json_headers)
 
     def get(self, url, **kwargs):
-        return json.loads(self.get_raw(url, **kwargs))
+        return json_loads(self.get_raw(url, **kwargs))
 
     def post(self, url, data=None, files=None):
         if files:
@@ -53,71 +319,27 @@ class Scout(object):
             return self.post_json(url, data)
 
     def post_json(self, url, data=None):
-        headers = {'Content-Type': 'application/json'}
-        if self.key:
-            headers['key'] = self.key
-        data = json.dumps(data or {})
-        if not isinstance(data, bytes):
-            data = data.encode('utf-8')
-        request = Request(self.get_full_url(url), data=data, headers=headers)
-        return json.loads(urlopen(request).read().decode('utf8'))
+        data = json_dumps(data or {})
+        return json_loads(self.request('POST', url, data,
+                                       self._json_headers))
 
     def post_files(self, url, json_data, files=None):
         if not files or not isinstance(files, dict):
             raise ValueError('One or more files is required. Files should be '
                              'passed as a dictionary of filename: file-like-'
                              'object.')
-        boundary = choose_boundary()
-        form_files = []
-        for i, (filename, file_obj) in enumerate(files.items()):
-            try:
-                data = file_obj.read()
-            except AttributeError:
-                data = bytes(file_obj)
-            mimetype = mimetypes.guess_type(filename)[0]
-            form_files.append((
-                'file_%s' % i,
-                filename,
-                mimetype or 'application/octet-stream',
-                data))
-
-        part_boundary = '--' + boundary
-        parts = [
-            part_boundary,
-            'Content-Disposition: form-data; name="data"',
-            '',
-            json.dumps(json_data)]
-        for field_name, filename, mimetype, data in form_files:
-            parts.extend((
-                part_boundary,
-                'Content-Disposition: file; name="%s"; filename="%s"' % (
-                    field_name, filename),
-                'Content-Type: %s' % mimetype,
-                '',
-                data))
-        parts.append('--' + boundary + '--')
-        parts.append('')
-
-        headers = {'Content-Type': 'multipart/form-data; boundary=%s' %
-                   boundary}
-        if self.key:
-            headers['key'] = self.key
-
-        data = '\r\n'.join(parts)
-        if not isinstance(data, bytes):
-            data = data.encode('utf-8')
+        body = MultipartBody(choose_boundary(), json_data, files)
+        headers = {
+            'Content-Length': str(len(body)),
+            'Content-Type': 'multipart/form-data; boundary="%s"' %
+                            body.boundary}
+        headers.update(self._key_headers)
 
-        request = Request(self.get_full_url(url), data=data, headers=headers)
-        return json.loads(urlopen(request).read())
+        return json_loads(self.request('POST', url, body, headers))
 
     def delete(self, url):
-        headers = {}
-        if self.key:
-            headers['key'] = self.key
-        request = Request(self.get_full_url(url), headers=headers)
-        request.get_method = lambda: 'DELETE'
-        fh = urlopen(request)
-        return json.loads(fh.read())
+        return json_loads(self.request('DELETE', url,
+                                       headers=self._key_headers))
 
     def get_indexes(self, **kwargs):
         return self.get('/', **kwargs)['indexes']
@@ -134,20 +356,58 @@ class Scout(object):
     def get_index(self, name, **kwargs):
         return self.get('/%s/' % name, **kwargs)
 
+    def search_many(self, searches, max_workers=8):
+        """
+        Perform any number of index searches concurrently, given as an
+        iterable of (index name, parameters) 2-tuples. Returns a list of the
+        results, in the same order as the searches.
+        """
+        searches = list(searches)
+
+        def search(item):
+            name, params = item
+            return self.get_index(name, **(params or {}))
+
+        if ThreadPoolExecutor is None or len(searches) < 2:
+            return [search(item) for item in searches]
+
+        max_workers = min(max_workers, self.pool.maxsize, len(searches))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(search, searches))
+
     def get_documents(self, **kwargs):
         return self.get('/documents/', **kwargs)
 
+    def iter_documents(self, **kwargs):
+        """
+        Iterate over all the documents matching the given parameters,
+        requesting one page of results at a time, so that only a single page
+        is held in memory. Pages are requested using a cursor, so each page
+        is as cheap to fetch as the first.
+        """
+        cursor = ''
+        while cursor is not None:
+            response = self.get_documents(cursor=cursor, **kwargs)
+            for document in response['documents']:
+                yield document
+            cursor = response['next_cursor']
+
     def create_document(self, content, indexes, identifier=None,
                         attachments=None, **metadata):
-        if not isinstance(indexes, (list, tuple)):
-            indexes = [indexes]
         post_data = {
             'content': content,
             'identifier': identifier,
-            'indexes': indexes,
+            'indexes': _as_list(indexes),
             'metadata': metadata}
         return self.post('/documents/', post_data, attachments)
 
+    def store_documents(self, documents):
+        documents = [
+            dict(document, indexes=_as_list(document['indexes']))
+            if 'indexes' in document else document
+            for document in documents]
+        return self.post('/batch/documents/', {'documents': documents})
+
     def update_document(self, document_id=None, content=None, indexes=None,
                         metadata=None, identifier=None, attachments=None):
         if not document_id and not identifier:
@@ -157,9 +417,7 @@ class Scout(object):
         if content is not None:
             data['content'] = content
         if indexes is not None:
-            if not isinstance(indexes, (list, tuple)):
-                indexes = [indexes]
-            data['indexes'] = indexes
+            data['indexes'] = _as_list(indexes)
         if metadata is not None:
             data['metadata'] = metadata
 
@@ -28,6 +28,8 @@ setup(
     install_requires=[
         'flask',
         'peewee>=3.0.0'],
+    extras_require={
+        'speedups': ['flask-compress', 'orjson']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',